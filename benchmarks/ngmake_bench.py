@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+
+"""NAME
+    ngmake_bench  -- benchmarks of the ngmake compiler
+
+
+USAGE
+
+    # to run all benchmarks and save the results
+    benchmarks/ngmake_bench.py run -o results.json
+
+    # to run some benchmarks, on inputs twice as large as by default
+    benchmarks/ngmake_bench.py run --scale 2 cxx_targets long_recipe
+
+    # to compare two runs; exits with 1 if any regression was found
+    benchmarks/ngmake_bench.py compare baseline.json results.json
+
+    # to list benchmarks
+    benchmarks/ngmake_bench.py list
+
+
+DESCRIPTION
+
+    Every benchmark generates a synthetic Ngmakefile (and modules it imports) and compiles it with
+    the functions of ngmake.py, the same way the command line tool does, timing every phase:
+    lex, statements, imports, prepare, expansion, and output.
+    Every benchmark is run several times; the minimum and the median time of every phase are
+    recorded, together with a checksum of the produced Makefile.
+
+    Modules are looked up relative to the working directory, so benchmarks are run in a temporary
+    directory which holds generated modules and a link to the standard library.
+    The on-disk module cache is not used; imports are parsed on every run.
+
+
+OPTIONS
+
+    run [<benchmark>...]
+        -o, --output <file>     write results to <file> (default: standard output)
+        -r, --repeat <n>        run every benchmark <n> times (default: 5)
+        -s, --scale <factor>    multiply sizes of generated inputs by <factor> (default: 1)
+
+    compare <baseline> <results>
+        -t, --threshold <ratio> report phases slower by more than <ratio> (default: 0.10)
+        --min-delta <seconds>   ignore differences smaller than <seconds> (default: 0.005)
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY)
+
+import ngmake
+
+
+PHASES = ('lex', 'statements', 'imports', 'prepare', 'expansion', 'output',)
+
+
+# Generators of workloads.
+# Every generator returns source of the Ngmakefile, and a dictionary of modules it imports
+# (paths relative to the working directory mapped to their sources).
+
+# Typical C++ project: every target built by std::cxx's default_cxx_target.
+def generate_cxx_targets(targets = 5000, dependencies = 4):
+    lines = [
+        "import 'std::cxx'.",
+        "let cxx = 'g++'.",
+        "let cxxflags = [ '-std=c++17', '-O2', '-Wall' ].",
+    ]
+    for i in range(targets):
+        deps = ["'src/t{}.cpp'".format(i), "'include/t{}.h'".format(i)]
+        deps.extend("'src/common{}.cpp'".format(j) for j in range(dependencies - 2))
+        lines.append("do ('build/t{}.o', [ {} ]) -> default_cxx_target .".format(i, ', '.join(deps)))
+    return '\n'.join(lines) + '\n', {}
+
+# Recursion over long lists: a recursive macro defined in Ngmake (quadratic in the length of the
+# list), and std::list macros.
+def generate_list_recursion(targets = 20, length = 300):
+    lines = [
+        "import 'std::list'.",
+        "import 'std::bool'.",
+        "",
+        "macro my_reverse ( only ) ->",
+        "    gather( only )",
+        "; my_reverse ( first, ...rest ) ->",
+        "    gather( ...my_reverse( ...rest ), first )",
+        ".",
+        "",
+        "macro is_header ( path ) -> match( path, '.*\\.h$' ) .",
+    ]
+    for i in range(targets):
+        deps = ', '.join("'src/t{}/f{}.{}'".format(i, j, ('h' if j % 3 == 0 else 'cpp')) for j in range(length))
+        lines.extend([
+            "do ('list{}', [ {} ]) -> (name, deps) ->".format(i, deps),
+            "    echo( ...my_reverse( ...deps ) ),",
+            "    echo( ...reverse( ...deps ) ),",
+            "    echo( ...filter( is_header, ...deps ) ),",
+            "    echo( all( bool, ...deps ) )",
+            ".",
+        ])
+    return '\n'.join(lines) + '\n', {}
+
+# Conditional expansion: 'if' on results of 'match' and 'boolean'.
+def generate_conditionals(targets = 3000, conditions = 6):
+    lines = [
+        "import 'std::util'.",
+        "import 'std::bool'.",
+        "",
+        "macro kind ( path ) ->",
+        "    if match( path, '.*\\.cpp$' ) -> 'c++' else if match( path, '.*\\.c$' ) -> 'c' else 'other'",
+        ".",
+    ]
+    extensions = ('cpp', 'c', 'txt',)
+    for i in range(targets):
+        lines.append("do ('out/t{}', [ 'src/t{}.{}' ]) -> (name, deps) ->".format(i, i, extensions[i % len(extensions)]))
+        steps = []
+        for j in range(conditions):
+            if j % 2:
+                steps.append("    echo( if boolean name -> kind( ...deps ) else 'none' )")
+            else:
+                steps.append("    echo( if match( name, '.*{}$' ) -> name else kind( ...deps ) )".format(j))
+        lines.append(',\n'.join(steps))
+        lines.append('.')
+    return '\n'.join(lines) + '\n', {}
+
+# Wide import graph: the Ngmakefile imports many modules, every one of which imports a few others
+# (and std::util), and targets use macros from all of them.
+def generate_wide_imports(modules = 200, macros = 10, fan_out = 4, targets = 1000):
+    sources = {}
+    for i in range(modules):
+        lines = ["import 'std::util'."]
+        lines.extend("import 'bench::m{}'.".format(j) for j in range(i + 1, min(i + 1 + fan_out, modules)))
+        for j in range(macros):
+            lines.append("macro m{}_{} ( x ) -> echo( 'm{}' x ) .".format(i, j, i))
+        sources[os.path.join('bench', 'm{}.ngmake'.format(i))] = '\n'.join(lines) + '\n'
+
+    lines = ["import 'bench::m{}'.".format(i) for i in range(modules)]
+    for i in range(targets):
+        lines.append("do ('w{}') -> (name) -> m{}_{}( name ), m{}_{}( name ) .".format(
+            i, (i % modules), (i % macros), ((i * 7) % modules), ((i * 3) % macros),
+        ))
+    return '\n'.join(lines) + '\n', sources
+
+# Very long recipes: a few targets with thousands of steps each.
+def generate_long_recipe(targets = 2, steps = 5000, width = 8):
+    lines = [
+        "import 'std::util'.",
+        "let flags = [ {} ].".format(', '.join("'-f{}'".format(i) for i in range(width))),
+        "macro step ( n ) -> 'echo' 'step' n ...flags .",
+    ]
+    for i in range(targets):
+        lines.append("do ('recipe{}') -> (name) ->".format(i))
+        lines.append(',\n'.join("    step( '{}' )".format(j) for j in range(steps)))
+        lines.append('.')
+    return '\n'.join(lines) + '\n', {}
+
+# Every benchmark is a generator and its default parameters; --scale multiplies the first one.
+BENCHMARKS = {
+    'cxx_targets': (generate_cxx_targets, { 'targets': 5000, 'dependencies': 4, }),
+    'list_recursion': (generate_list_recursion, { 'length': 300, 'targets': 20, }),
+    'conditionals': (generate_conditionals, { 'targets': 3000, 'conditions': 6, }),
+    'wide_imports': (generate_wide_imports, { 'modules': 200, 'macros': 10, 'fan_out': 4, 'targets': 1000, }),
+    'long_recipe': (generate_long_recipe, { 'steps': 5000, 'targets': 2, 'width': 8, }),
+}
+
+def scaled_parameters(parameters, scale):
+    scaled = dict(parameters)
+    first = next(iter(parameters))
+    scaled[first] = max(1, int(parameters[first] * scale))
+    return scaled
+
+
+# Compile source text the way ngmake's main does, and time every phase.
+# Returns times of the phases and the text of the Makefile.
+def compile_source(source_text):
+    times = dict.fromkeys(PHASES, 0.0)
+    last = time.perf_counter()
+
+    def checkpoint(phase):
+        nonlocal last
+        now = time.perf_counter()
+        times[phase] += (now - last)
+        last = now
+
+    tokens = ngmake.generic_lexer(source_text)
+    checkpoint('lex')
+    statements = ngmake.split_statements(tokens)
+    checkpoint('statements')
+
+    own_macros = { each['name']: each for each in (ngmake.prepare_macro(tokens, *each) for each in statements[ngmake.TOKEN_MACRO]) }
+    checkpoint('prepare')
+    registry = ngmake.ModuleRegistry(None)
+    macros = registry.namespace(list(ngmake.import_names(tokens, statements[ngmake.TOKEN_IMPORT])), own_macros)
+    macros.maps.append(ngmake.builtin_macros())
+    macros = dict(macros)
+    checkpoint('imports')
+
+    variables = { each['name']: each['value'] for each in (ngmake.prepare_variable(tokens, *each) for each in statements[ngmake.TOKEN_LET]) }
+    targets = [ngmake.prepare_target(tokens, start, limit, macros) for start, limit in statements[ngmake.TOKEN_DO]]
+    checkpoint('prepare')
+
+    cache = ngmake.ExpansionCache()
+    compiled = [ngmake.compile(each, variables, macros, cache) for each in targets]
+    checkpoint('expansion')
+
+    makefile = ''.join((ngmake.render_rule(each) + '\n') for each in compiled)
+    checkpoint('output')
+
+    return times, makefile
+
+def write_sources(directory, modules):
+    os.symlink(os.path.join(REPOSITORY, 'std'), os.path.join(directory, 'std'))
+    for path, source in modules.items():
+        path = os.path.join(directory, path)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(path, 'w') as ofstream:
+            ofstream.write(source)
+
+def summary(samples):
+    return { 'min': min(samples), 'median': statistics.median(samples), }
+
+def run_benchmark(name, scale, repeat):
+    generator, parameters = BENCHMARKS[name]
+    parameters = scaled_parameters(parameters, scale)
+    source_text, modules = generator(**parameters)
+
+    samples = { phase: [] for phase in PHASES + ('total',) }
+    checksum = None
+    working_directory = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix = 'ngmake-bench-') as directory:
+        write_sources(directory, modules)
+        os.chdir(directory)
+        try:
+            for _ in range(repeat):
+                times, makefile = compile_source(source_text)
+                for phase, seconds in times.items():
+                    samples[phase].append(seconds)
+                samples['total'].append(sum(times.values()))
+                checksum = hashlib.sha256(makefile.encode('utf-8')).hexdigest()
+        finally:
+            os.chdir(working_directory)
+
+    return {
+        'parameters': parameters,
+        'source_size': len(source_text),
+        'checksum': checksum,
+        'phases': { phase: summary(each) for phase, each in samples.items() },
+    }
+
+def run(names, scale, repeat, output):
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'scale': scale,
+        'repeat': repeat,
+        'benchmarks': {},
+    }
+    for name in names:
+        print('{}...'.format(name), end = ' ', file = sys.stderr, flush = True)
+        results['benchmarks'][name] = run_benchmark(name, scale, repeat)
+        print('{:.3f}s'.format(results['benchmarks'][name]['phases']['total']['min']), file = sys.stderr)
+
+    if output is None:
+        json.dump(results, sys.stdout, indent = 2)
+        print('')
+    else:
+        with open(output, 'w') as ofstream:
+            json.dump(results, ofstream, indent = 2)
+            ofstream.write('\n')
+
+# Compare minimum times of phases of two runs.
+# A phase regressed if it is slower by more than the threshold (as a fraction of the baseline time)
+# and by more than the minimum delta (to ignore noise in very short phases).
+def compare(baseline_file, results_file, threshold, min_delta):
+    with open(baseline_file) as ifstream:
+        baseline = json.load(ifstream)
+    with open(results_file) as ifstream:
+        results = json.load(ifstream)
+
+    regressions = 0
+    print('{:<16} {:<12} {:>12} {:>12} {:>8}'.format('benchmark', 'phase', 'baseline [s]', 'results [s]', 'change'))
+    for name, result in results['benchmarks'].items():
+        old = baseline['benchmarks'].get(name)
+        if old is None:
+            print('{:<16} not in baseline'.format(name))
+            continue
+        if old['parameters'] != result['parameters']:
+            print('{:<16} parameters differ, not compared'.format(name))
+            continue
+
+        for phase in PHASES + ('total',):
+            before = old['phases'][phase]['min']
+            after = result['phases'][phase]['min']
+            change = ((after - before) / before if before else 0.0)
+            regressed = (change > threshold and (after - before) > min_delta)
+            regressions += regressed
+            print('{:<16} {:<12} {:>12.4f} {:>12.4f} {:>+7.1%}{}'.format(
+                name, phase, before, after, change, ('  REGRESSION' if regressed else ''),
+            ))
+        if old['checksum'] != result['checksum']:
+            print('{:<16} output differs from baseline'.format(name))
+
+    print('{} regression(s)'.format(regressions))
+    return (1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(prog = 'ngmake_bench')
+    subcommands = argument_parser.add_subparsers(dest = 'command', required = True)
+
+    run_parser = subcommands.add_parser('run')
+    run_parser.add_argument('-o', '--output')
+    run_parser.add_argument('-r', '--repeat', type = int, default = 5)
+    run_parser.add_argument('-s', '--scale', type = float, default = 1.0)
+    run_parser.add_argument('benchmarks', nargs = '*')
+
+    compare_parser = subcommands.add_parser('compare')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('results')
+    compare_parser.add_argument('-t', '--threshold', type = float, default = 0.10)
+    compare_parser.add_argument('--min-delta', type = float, default = 0.005)
+
+    subcommands.add_parser('list')
+
+    args = argument_parser.parse_args()
+
+    if args.command == 'run':
+        for each in args.benchmarks:
+            if each not in BENCHMARKS:
+                argument_parser.error('unknown benchmark: {}'.format(each))
+        run((args.benchmarks or list(BENCHMARKS)), args.scale, args.repeat, args.output)
+    elif args.command == 'compare':
+        exit(compare(args.baseline, args.results, args.threshold, args.min_delta))
+    else:
+        for name, (generator, parameters) in BENCHMARKS.items():
+            print('{}: {}'.format(name, ', '.join('{}={}'.format(*each) for each in parameters.items())))
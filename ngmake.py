@@ -9,10 +9,134 @@ USAGE
     # to compile Ngmake source
     ngmake Ngmakefile > Makefile
 
+    # to compile only some targets (shell-style wildcards are accepted)
+    ngmake Ngmakefile <target>... > Makefile
+    ngmake Ngmakefile 'build/bin/*' > Makefile
+
+    # to write the Makefile only if the compilation succeeds
+    ngmake -o Makefile Ngmakefile
+
+    # to compile Ngmake source to a Ninja build file
+    ngmake --backend ninja -o build.ninja Ngmakefile
+
+    # to build targets without writing a Makefile, running up to 8 recipes at a time
+    ngmake --run -j 8 Ngmakefile [<target>...]
+
+    # to rebuild targets only when contents of their inputs change
+    ngmake --stamps .ngmake-stamps Ngmakefile > Makefile
+
     # to display this help message
     ngmake
 
 
+OPTIONS
+
+    --debug
+        Expand all targets but do not print the Makefile; print statistics of the expansion and
+        module caches to standard error.
+
+    --expansion-cache-size <size>
+        Maximum number of macro expansions remembered by the expansion cache (default: 4096).
+        Use 0 to disable the cache.
+
+    --no-module-cache
+        Do not use the on-disk cache of parsed modules.
+        The cache lives in $XDG_CACHE_HOME/ngmake (~/.cache/ngmake by default); entries are
+        invalidated when mtime or size of the module file changes, or when ngmake itself changes.
+
+    --verify-module-cache
+        Hash contents of every imported module and use the cached entry only if the hash matches.
+
+    --incremental <state-file>
+        Reuse rules compiled by a previous run.
+        For every target the state file records its tokens, and the macros and global variables
+        its expansion used; only targets for which any of these changed are expanded again, rules
+        of the other targets are copied from the state file.
+        The state file is rewritten after every successful run.
+
+    -j <jobs>, --jobs <jobs>
+        Compile targets in a pool of <jobs> worker processes (default: 1).
+        Rules are printed in the order of targets in the source file.
+        Every worker has its own expansion cache.
+        With --run, also the number of recipes run at the same time.
+
+    --run
+        Build the targets instead of printing the Makefile.
+        All targets are compiled; the selected targets (or the first target if none are selected)
+        and everything they depend on are then built the way GNU Make would build them from the
+        Makefile: a target is rebuilt if it does not exist, is listed as a dependency of '.PHONY',
+        or if any of its dependencies is newer or was rebuilt without producing a file.
+        Every line of a recipe is run by /bin/sh; a line beginning with '@' is not echoed, and
+        failure of a line beginning with '-' is ignored. No Make variables are expanded.
+        Targets are started as soon as all their dependencies are built.
+        When the build ends the time it took and its critical path (the chain of dependent
+        recipes which took the longest) are reported to standard error.
+
+    --glob-index <file>
+        Keep listings of directories read by glob() in <file> for the next run, together with
+        modification times of the directories; a directory is read again only if its modification
+        time changed. Listings of directories a run did not visit are kept as long as they are
+        valid, and listings read by -j workers are saved too.
+
+    --include-cache <file>
+        Keep #include directives read by includes() in <file> for the next run, together with
+        modification times and sizes of the files; a file is read again only if either changed.
+        Saved directives of files a run did not read are kept as long as they are valid, and
+        directives read by -j workers are saved too.
+
+    -k, --keep-going
+        With --run, keep building targets which do not depend on a failed one instead of stopping
+        after the first failure.
+
+    --stamps <directory>
+        Make targets depend on contents of their inputs instead of their modification times.
+        Every dependency which is not a target itself and is a regular file (an input) is replaced
+        by a stamp file in <directory> holding a hash of the input's contents; the stamp file is
+        rewritten only when the hash changes, so touching an input does not rebuild anything.
+        Other dependencies (e.g. directories, or files missing when the Makefile is written) are
+        left as they are.
+        Stamp files are updated by 'ngmake --update-stamps <directory>', which the Makefile runs
+        before anything else is built (with --run they are updated before the build starts).
+        Not available with --backend ninja.
+
+    --update-stamps <directory>
+        Update stamp files in <directory> for inputs recorded there by --stamps, and exit.
+        The directory keeps a database of modification times, sizes, and hashes of inputs;
+        only inputs whose modification time or size changed since the last update are hashed,
+        in parallel (large files are memory-mapped instead of read).
+
+    --profile
+        Report where the time goes to standard error: wall time and peak memory use of every
+        phase of compilation, and for every macro: number of expansions, expansions taken from the
+        expansion cache, how many times each clause was selected, and cumulative and self time.
+        Peak memory is the peak resident set size during the phase alone (not since the start of
+        the process; phases interleaved within 10 ms, like expansion and output, share samples);
+        it is measured only on Linux, and shown as '-' elsewhere.
+        Targets are compiled in a single process when profiling, regardless of -j.
+
+    --profile-format table|json
+        Format of the profile (default: table). Implies --profile.
+
+    --profile-folded <file>
+        Write self time of every stack of macro expansions (in microseconds, rooted at targets)
+        to <file> in the folded format accepted by flame graph tools. Implies --profile.
+
+    --backend make|ninja
+        Produce a GNU Makefile (default), or a Ninja build file.
+        For Ninja, steps of a recipe are joined with '&&', so unlike with Make they run in a single
+        shell (e.g. a 'cd' in one step carries over to the next ones); Make's '@' and '+' prefixes
+        are dropped, and a step prefixed with '-' becomes '(step || true)'. Recipes which differ
+        only in the target and in the leading dependencies they mention share a rule, in which
+        these are replaced by $out and $in (remaining dependencies become implicit inputs).
+        Several targets with the same name are merged like Make merges them, and special Make
+        targets (e.g. '.PHONY') are left out.
+
+    -o <file>, --output <file>
+        Write the Makefile to <file> instead of standard output.
+        The file is replaced only when compilation succeeds, and is left untouched (keeping its
+        mtime) when its contents would not change.
+
+
 DESCRIPTION
 
     Ngmake is a compiler from a free-form, declarative, functional language to GNU Makefiles.
@@ -25,7 +149,7 @@ DESCRIPTION
     All variables are expanded by Ngmake so overriding variables like 'make CXX=g++ all' will
     not work.
     GNU Make is used by Ngmake *only* as a dependency solver; everything else happens on the Ngmake
-    side.
+    side. This also makes it possible to use Ninja instead of Make (see --backend).
 
 
 CONCEPTS
@@ -228,6 +352,12 @@ CONCEPTS
             /* Ngmake */
             do ('build/bin/foo', [ 'src/foo.cpp' ])
 
+        Dependencies may also be given by an expression (e.g. a variable, or a macro expansion)
+        which is expanded when the target is compiled; lists in its value are flattened.
+
+            do ('build/bin/foo', glob( 'src/foo/*.cpp' )) -> compiled .
+            do ('build/bin/bar', sources) -> compiled .
+
     IF
 
             if <condition> -> <expression-if-true> else <expression-if-false>
@@ -238,11 +368,63 @@ CONCEPTS
         Both true and false branch *MUST* contain a valid expression.
         Should any of them evaluate to nothing (meaning that only the other branch should be taken) the
         "null macro" can be used.
+        Only the branch that is taken is expanded, so the other one may e.g. recurse into a macro
+        clause that would not match.
 
             macro null () -> .
 
             macro foo ( something ) -> if something -> echo( something ) else null() .
 
+BUILTIN MACROS
+
+    These macros are implemented by Ngmake itself and are always available.
+    Macros with the same names defined in Ngmake source shadow them.
+    Patterns are Python regular expressions, matched at the beginning of each string.
+
+            match( <string>, <pattern> )
+
+        Expands to true if the string matches the pattern, and to false otherwise.
+
+            select_matching( <pattern>, <items>... )
+            reject_matching( <pattern>, <items>... )
+
+        Expand to a list of the items that match (or do not match) the pattern.
+        Whole lists are filtered in a single pass, for example:
+
+            compile( name, ...reject_matching( '.*\\.h$', ...deps ) )
+
+            substitute( <pattern>, <replacement>, <items>... )
+
+        Expands to a list of the items with every match of the pattern replaced.
+
+            ...substitute( '\\.cpp$', '.o', ...sources )
+
+            glob( <pattern>... )
+
+        Expands to a sorted list of paths of files and directories matching any of the shell-style
+        patterns ('*', '?', and '[...]' match within a single path component, '**' matches any
+        number of directories). Names beginning with '.' are matched only by components beginning
+        with '.'; symbolic links to directories are not followed by '**'.
+        Paths are relative to the current directory. Every directory is listed at most once per
+        run, no matter how many patterns visit it (see also --glob-index).
+
+            do ('build/bin/foo', glob( 'src/**/*.cpp' )) -> compiled .
+
+            includes( <source>, <include-directories>... )
+
+        Expands to a list of headers the C or C++ source file includes, directly or through other
+        headers, in the order they are found. Headers included with quotes are looked for in the
+        directory of the including file first, then in the include directories; headers included
+        with angle brackets only in the include directories. Headers which are not found (e.g.
+        system headers) are left out. Directives are read from the text of the files without
+        preprocessing, so headers included under any condition are listed.
+        Every file is read at most once per run (in a pool of threads), and every header name is
+        looked up once per run for the same including directory and include directories (see also
+        --include-cache). 'with_includes' from 'std::cxx' gives the source followed by its headers:
+
+            do ('build/foo.o', with_includes( 'src/foo.cpp', 'include' )) -> default_cxx_target .
+
+
 AUTHOR
 
     Ngmake is written and maintained by Marek Marecki.
@@ -269,10 +451,26 @@ SEE ALSO
     make(1)
 """
 
+import argparse
+import bisect
+import collections
+import concurrent.futures
+import fnmatch
+import hashlib
+import itertools
+import json
+import mmap
+import multiprocessing
 import os
+import pickle
 import re
+import shlex
+import stat
 import string
+import subprocess
 import sys
+import tempfile
+import time
 
 
 name_regex = re.compile('^[a-zA-Z_][a-zA-Z0-9_]*$')
@@ -282,23 +480,70 @@ class InvalidSyntax(Exception):
     pass
 
 
-def extract(source):
-    quote = source[0]
-    i = 1
-    backs = False
-    while i < len(source):
-        if source[i] == quote and not backs:
-            break
-        if backs and source[i] != '\\':
-            backs = False
-        if source[i] == '\\':
-            backs = not backs
-        i += 1
-    return source[:i+1]
+# Token kinds.
+# Structural tokens and keywords get their own kinds so the parser compares integers
+# instead of strings; everything else is a name, a quoted string, or other punctuation.
+TOKEN_NAME = 0
+TOKEN_STRING = 1
+TOKEN_PUNCTUATION = 2
+TOKEN_ARROW = 3
+TOKEN_SPREAD = 4
+TOKEN_DOT = 5
+TOKEN_COMMA = 6
+TOKEN_SEMICOLON = 7
+TOKEN_EQUALS = 8
+TOKEN_PAREN_OPEN = 9
+TOKEN_PAREN_CLOSE = 10
+TOKEN_BRACKET_OPEN = 11
+TOKEN_BRACKET_CLOSE = 12
+TOKEN_DO = 13
+TOKEN_LET = 14
+TOKEN_MACRO = 15
+TOKEN_IMPORT = 16
+TOKEN_IF = 17
+TOKEN_ELSE = 18
+TOKEN_BOOLEAN = 19
+TOKEN_TRUE = 20
+TOKEN_FALSE = 21
+
+TOKEN_KINDS = {
+    '->': TOKEN_ARROW,
+    '...': TOKEN_SPREAD,
+    '.': TOKEN_DOT,
+    ',': TOKEN_COMMA,
+    ';': TOKEN_SEMICOLON,
+    '=': TOKEN_EQUALS,
+    '(': TOKEN_PAREN_OPEN,
+    ')': TOKEN_PAREN_CLOSE,
+    '[': TOKEN_BRACKET_OPEN,
+    ']': TOKEN_BRACKET_CLOSE,
+    'do': TOKEN_DO,
+    'let': TOKEN_LET,
+    'macro': TOKEN_MACRO,
+    'import': TOKEN_IMPORT,
+    'if': TOKEN_IF,
+    'else': TOKEN_ELSE,
+    'boolean': TOKEN_BOOLEAN,
+    'true': TOKEN_TRUE,
+    'false': TOKEN_FALSE,
+}
+
+def token_kind(text):
+    kind = TOKEN_KINDS.get(text)
+    if kind is not None:
+        return kind
+    if text[0] in ('"', "'",):
+        return TOKEN_STRING
+    if text[0] in PUNCTUATION:
+        return TOKEN_PUNCTUATION
+    return TOKEN_NAME
 
 class Token:
-    def __init__(self, text, line, character):
-        self._text = text
+    __slots__ = ('_text', 'kind', '_line', '_character',)
+
+    def __init__(self, text, line, character, kind = None):
+        self._text = sys.intern(text)
+        self.kind = (token_kind(text) if kind is None else kind)
         self._line = line
         self._character = character
 
@@ -316,7 +561,7 @@ class Token:
             return self._text == other
         elif type(other) is Token:
             return (
-                (self._text == other._line) and
+                (self._text == other._text) and
                 (self._line == other._line) and
                 (self._character == other._character)
             )
@@ -327,104 +572,56 @@ class Token:
         return (self._line, self._character,)
 
 
-def generic_lexer(source):
-    line_no, char_no = 0, 0
-    tokens = []
-    token, c = '', ''
-    punctuation = string.punctuation.replace('"', '').replace("'", '').replace('_', '')
-
-    i = 0
-    while i < len(source):
-        c = source[i]
-        if c == ' ' or c == '\t':
-            if token:
-                tokens.append(Token(
-                    text = token,
-                    line = line_no,
-                    character = (char_no - len(token)),
-                ))
-                token = ''
-        elif c == '\n':
-            if token:
-                tokens.append(Token(
-                    text = token,
-                    line = line_no,
-                    character = (char_no - len(token)),
-                ))
-                token = ''
+PUNCTUATION = string.punctuation.replace('"', '').replace("'", '').replace('_', '')
+
+lexer_regex = re.compile(r'''
+    (?P<newline>\n)
+    | (?P<space>[ \t]+)
+    | (?P<comment>/\*.*?(?:\*/|\Z))
+    | (?P<string>'(?:[^'\\]|\\.|\\\Z)*'?|"(?:[^"\\]|\\.|\\\Z)*"?)
+    | (?P<operator>->|\.\.\.)
+    | (?P<punctuation>[{punctuation}])
+    | (?P<word>[^ \t\n'"{punctuation}]+)
+'''.format(punctuation = re.escape(PUNCTUATION)), re.VERBOSE | re.DOTALL)
+
+# Single pass over the source; operators ('->', '...'), comments, and quoted strings are
+# recognised directly by the regex so no reduction passes are needed afterwards.
+# Lexes source[start:limit]; line_no and line_start give the line on which start lies, and
+# the offset at which that line begins.
+def lex_tokens(source, start = 0, limit = None, line_no = 0, line_start = 0):
+    token_kinds_get = TOKEN_KINDS.get
+
+    for match in lexer_regex.finditer(source, start, (len(source) if limit is None else limit)):
+        kind = match.lastgroup
+        if kind == 'newline':
             line_no += 1
-            char_no = 0
-        elif i < (len(source)-1) and c == '/' and source[i+1] == '*':
-            i += 1
-            while i < len(source)-1 and not (source[i] == '*' and source[i+1] == '/'):
-                if source[i] == '\n':
-                    line_no += 1
-                i += 1
-            i += 2
-            continue
-        elif c in punctuation:
-            if token:
-                tokens.append(Token(
-                    text = token,
+            line_start = match.end()
+        elif kind == 'space':
+            pass
+        elif kind == 'comment' or kind == 'string':
+            text = match.group()
+            if kind == 'string':
+                yield Token(
+                    text = text,
                     line = line_no,
-                    character = (char_no - len(token)),
-                ))
-                token = ''
-            tokens.append(Token(
-                text = c,
-                line = line_no,
-                character = (char_no - len(token)),
-            ))
-        elif c == '"' or c == "'":
-            if token:
-                tokens.append(Token(
-                    text = token,
-                    line = line_no,
-                    character = (char_no - len(token)),
-                ))
-                token = ''
-            token = extract(source[i:])
-            tokens.append(Token(
-                text = token,
-                line = line_no,
-                character = (char_no - len(token)),
-            ))
-            i += len(token)-1
-            token = ''
-        else:
-            token += c
-        i += 1
-        char_no += 1
-
-    return tokens
-
-
-def reduce_arrow_operator(tokens):
-    reduced_tokens = []
-    i = 0
-    while i < len(tokens):
-        if tokens[i] == '-' and tokens[i+1] == '>':
-            reduced_tokens.append(Token('->', *(tokens[i].position())))
-            i += 1
-        else:
-            reduced_tokens.append(tokens[i])
-        i += 1
-    return reduced_tokens
-
-def reduce_spread_operator(tokens):
-    reduced_tokens = []
-
-    i, limit = 0, len(tokens)
-
-    while i < limit:
-        if i < limit-3 and tokens[i] == '.' and tokens[i+1] == '.' and tokens[i+2] == '.':
-            reduced_tokens.append(Token('...', *(tokens[i].position())))
-            i += 2
+                    character = (match.start() - line_start),
+                    kind = TOKEN_STRING,
+                )
+            newlines = text.count('\n')
+            if newlines:
+                line_no += newlines
+                line_start = match.start() + text.rindex('\n') + 1
         else:
-            reduced_tokens.append(tokens[i])
-        i += 1
+            text = match.group()
+            yield Token(
+                text = text,
+                line = line_no,
+                character = (match.start() - line_start),
+                kind = token_kinds_get(text, (TOKEN_PUNCTUATION if kind == 'punctuation' else TOKEN_NAME)),
+            )
 
-    return reduced_tokens
+def generic_lexer(source):
+    return list(lex_tokens(source))
 
 
 class NgmakeType:
@@ -454,47 +651,137 @@ class Atom(NgmakeType):
         self._value = something
 
 
-def _match_group_from_to_dot(from_token, tokens):
-    matches = []
+STATEMENT_KINDS = (TOKEN_DO, TOKEN_LET, TOKEN_MACRO, TOKEN_IMPORT,)
+
+# Split the token stream into top-level statements in a single pass.
+# Returns a dictionary mapping statement kind (TOKEN_DO, TOKEN_LET, TOKEN_MACRO, TOKEN_IMPORT) to
+# a list of (start, end) ranges; each range covers a statement from its keyword to its final '.'.
+# Nesting of parentheses and brackets is tracked so only a top-level '.' ends a statement.
+def split_statements(tokens):
+    statements = { kind: [] for kind in STATEMENT_KINDS }
 
     i, limit = 0, len(tokens)
 
     while i < limit:
-        if tokens[i] == from_token:
-            part = []
-            part.append(tokens[i])
-            i += 1
-            while i < limit:
-                part.append(tokens[i])
-                if tokens[i] == '.':
-                    break
-                i += 1
-            matches.append(part)
-        i += 1
-
-    return matches
-
-def match_targets(tokens):
-    return _match_group_from_to_dot('do', tokens)
-
-def match_variables(tokens):
-    return _match_group_from_to_dot('let', tokens)
-
-def match_macros(tokens):
-    return _match_group_from_to_dot('macro', tokens)
-
-def match_imports(tokens):
-    return _match_group_from_to_dot('import', tokens)
+        statement = statements.get(tokens[i].kind)
+        if statement is None:
+            raise InvalidSyntax(tokens[i], 'expected a statement')
 
+        start = i
+        i += 1
+        balance = 0
+        while i < limit:
+            kind = tokens[i].kind
+            if kind == TOKEN_PAREN_OPEN or kind == TOKEN_BRACKET_OPEN:
+                balance += 1
+            elif kind == TOKEN_PAREN_CLOSE or kind == TOKEN_BRACKET_CLOSE:
+                balance -= 1
+            elif kind == TOKEN_DOT and balance == 0:
+                break
+            i += 1
+        if i == limit:
+            raise InvalidSyntax(tokens[start], 'missing final dot')
 
-def run_imports(to_import, macros, already_imported):
-    for each in to_import:
-        if each in already_imported:
+        # include final '.'
+        i += 1
+        statement.append((start, i,))
+
+    return statements
+
+def import_names(tokens, ranges):
+    return map(lambda each: str(tokens[each[0] + 1])[1:-1], ranges)
+
+statement_scanner_regex = re.compile(r'''
+    (?:[^'"/()\[\].]+ | '(?:[^'\\]|\\.|\\\Z)*'? | "(?:[^"\\]|\\.|\\\Z)*"? | /(?!\*))+
+    | /\*.*?(?:\*/|\Z)
+    | \.\.\.
+    | (?P<open>[(\[])
+    | (?P<close>[)\]])
+    | (?P<dot>\.)
+''', re.VERBOSE | re.DOTALL)
+
+# Find statements in the source text without lexing it.
+# The scanner looks only at brackets and dots (and at strings and comments, which may contain them)
+# and skips over everything else in long runs; statements end at the same dots as in
+# split_statements().
+# Returns offsets of the statements, and the offset of the text following the last one.
+def scan_statements(source):
+    ranges = []
+    start = 0
+    balance = 0
+    for match in statement_scanner_regex.finditer(source):
+        kind = match.lastgroup
+        if kind is None:
             continue
-        imported_macros, nested_imports = import_module(each, already_imported)
-        macros.update(imported_macros)
-        already_imported += nested_imports
-    return macros, already_imported
+        if kind == 'open':
+            balance += 1
+        elif kind == 'close':
+            balance -= 1
+        elif balance == 0:
+            ranges.append((start, match.end(),))
+            start = match.end()
+    return ranges, start
+
+# Statements of a source file, lexed on demand.
+# Only the first few tokens of every statement (enough to know its kind and name) are lexed up
+# front; a statement is lexed completely when it is first used. Errors are reported the same way
+# as by split_statements().
+class SourceStatements:
+    HEAD_LENGTH = 3
+
+    def __init__(self, source):
+        self._source = source
+        self._line_starts = [0] + [each.end() for each in re.finditer('\n', source)]
+        self._ranges = []
+        self._heads = []
+        self._statements = {}
+        self.kinds = { kind: [] for kind in STATEMENT_KINDS }
+
+        ranges, rest = scan_statements(source)
+        for start, limit in ranges:
+            head = self._head(start, limit)
+            self.kinds[head[0].kind].append(len(self._ranges))
+            self._ranges.append((start, limit,))
+            self._heads.append(head)
+
+        head = self._head(rest, len(source))
+        if head:
+            raise InvalidSyntax(head[0], 'missing final dot')
+
+    def _lex(self, start, limit):
+        line_no = bisect.bisect_right(self._line_starts, start) - 1
+        return lex_tokens(self._source, start, limit, line_no, self._line_starts[line_no])
+
+    def _head(self, start, limit):
+        head = list(itertools.islice(self._lex(start, limit), SourceStatements.HEAD_LENGTH))
+        if head and head[0].kind not in self.kinds:
+            raise InvalidSyntax(head[0], 'expected a statement')
+        return head
+
+    # Name of a target, macro, or variable; None if the statement is too short to have one.
+    def name(self, i):
+        head = self._heads[i]
+        if head[0].kind == TOKEN_DO:
+            return (target_name(head, 0, len(head)) if len(head) > 2 else None)
+        return (str(head[1]) if len(head) > 1 else None)
+
+    def index(self, kind):
+        return { self.name(i): i for i in self.kinds[kind] }
+
+    # Returns tokens of the statement, and the range of the statement in them.
+    def statement(self, i):
+        tokens = self._statements.get(i)
+        if tokens is None:
+            tokens = self._statements[i] = list(self._lex(*self._ranges[i]))
+        return tokens, 0, len(tokens)
+
+    def import_names(self):
+        return [
+            name
+            for i in self.kinds[TOKEN_IMPORT]
+            for name in import_names(self.statement(i)[0], [self.statement(i)[1:]])
+        ]
+
 
 def get_candidate_module_locations(name):
     name = name.replace('::', '/')
@@ -507,36 +794,201 @@ def get_candidate_module_locations(name):
     )
     return map(lambda each: each.format(name), locations)
 
-def import_module(name, already_imported = ()):
-    source_file = None
+def find_module(name):
     for each in get_candidate_module_locations(name):
-        if os.path.isfile(each):
-            source_file = each
-            break
-    else:
-        raise Exception('could not find module', name)
-
-    source_text = ''
-    with open(source_file) as ifstream:
-        source_text = ifstream.read()
-
-    raw_tokens = generic_lexer(source_text)
-
-    tokens = reduce_arrow_operator(raw_tokens)
-    tokens = reduce_spread_operator(tokens)
-
-    raw_macros = match_macros(tokens)
-
-    raw_imports = match_imports(tokens)
-
-    already_imported += (name,)
-    macros, nested_imports = run_imports(map(lambda s: str(s[1])[1:-1], raw_imports), {}, already_imported)
-    already_imported += nested_imports
-
-    for each in map(prepare_macro, raw_macros):
-        macros[each['name']] = each['overloads']
-
-    return macros, already_imported
+        try:
+            status = os.stat(each)
+        except OSError:
+            continue
+        if stat.S_ISREG(status.st_mode):
+            return each, status
+    raise Exception('could not find module', name)
+
+# Parse a module into names of the modules it imports and its own (prepared) macros.
+def parse_module(source_text):
+    tokens = generic_lexer(source_text)
+    statements = split_statements(tokens)
+
+    module = {
+        'imports': list(import_names(tokens, statements[TOKEN_IMPORT])),
+        'macros': {},
+    }
+    for start, end in statements[TOKEN_MACRO]:
+        each = prepare_macro(tokens, start, end)
+        module['macros'][each['name']] = each
+
+    return module
+
+# On-disk cache of parsed modules.
+# Entries are pickled parsed modules, one file per resolved module path, and are valid as long as
+# the mtime and size of the module file do not change, and only for the compiler that wrote them
+# (parsed modules are made of the compiler's data structures).
+# Each entry also records a hash of the module's contents; in verifying mode the module file is
+# read and hashed on every load and the entry is used only if the hashes match.
+MODULE_CACHE_VERSION = 2
+
+def default_module_cache_directory():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(os.path.join('~', '.cache'))
+    return os.path.join(base, 'ngmake')
+
+class ModuleCache:
+    def __init__(self, directory = None, verify = False):
+        self._directory = (directory or default_module_cache_directory())
+        self._verify = verify
+        self._compiler = compiler_fingerprint()
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_path(self, path):
+        return os.path.join(self._directory, (hashlib.sha256(path.encode('utf-8')).hexdigest() + '.pickle'))
+
+    def _load_entry(self, path):
+        return load_pickle(self._entry_path(path))
+
+    def _store_entry(self, path, entry):
+        try:
+            os.makedirs(self._directory, exist_ok = True)
+            store_pickle(self._entry_path(path), entry)
+        except OSError:
+            pass
+
+    def load(self, source_file, status):
+        path = os.path.realpath(source_file)
+        entry = self._load_entry(path)
+
+        valid = (
+            entry is not None and
+            entry.get('version') == MODULE_CACHE_VERSION and
+            entry.get('compiler') == self._compiler and
+            entry.get('path') == path and
+            entry.get('mtime') == status.st_mtime_ns and
+            entry.get('size') == status.st_size
+        )
+
+        source_bytes = None
+        if valid and self._verify:
+            source_bytes = read_bytes(source_file)
+            valid = (entry.get('hash') == hashlib.sha256(source_bytes).hexdigest())
+
+        if valid:
+            self.hits += 1
+            return entry['module']
+        self.misses += 1
+
+        if source_bytes is None:
+            source_bytes = read_bytes(source_file)
+        module = parse_module(source_bytes.decode('utf-8'))
+        self._store_entry(path, {
+            'version': MODULE_CACHE_VERSION,
+            'compiler': self._compiler,
+            'path': path,
+            'mtime': status.st_mtime_ns,
+            'size': status.st_size,
+            'hash': hashlib.sha256(source_bytes).hexdigest(),
+            'module': module,
+        })
+        return module
+
+def read_bytes(path):
+    with open(path, 'rb') as ifstream:
+        return ifstream.read()
+
+# Returns None if the file does not exist or cannot be unpickled.
+def load_pickle(path):
+    try:
+        with open(path, 'rb') as ifstream:
+            return pickle.load(ifstream)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, IndexError, TypeError, ValueError):
+        return None
+
+# The file is replaced atomically; readers see either the old or the new contents.
+def store_pickle(path, value):
+    fd, temporary_path = tempfile.mkstemp(dir = (os.path.dirname(path) or '.'), prefix = '.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as ofstream:
+            pickle.dump(value, ofstream, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+def load_module(source_file, status, module_cache = None):
+    if module_cache is not None:
+        return module_cache.load(source_file, status)
+    return parse_module(read_bytes(source_file).decode('utf-8'))
+
+# Registry of imported modules.
+# Every module is found, loaded, and parsed once per process, no matter how many times (and from
+# how many other modules) it is imported; modules are keyed by their canonical path.
+# Namespace of a module is a chain of tables instead of a merged copy: the module's own macros,
+# then native macros it provides, then namespaces of its imports (later imports take precedence).
+# Namespaces of imports are spliced into the chain, not nested in it, and a module imported again
+# (directly or through another import) is not added again: like a skipped import, it does not
+# override definitions imported after its first import. Otherwise modules imported along many
+# paths would be visited once per path on every lookup.
+class ModuleRegistry:
+    def __init__(self, module_cache = None):
+        self._module_cache = module_cache
+        self._namespaces = {}
+        self._importing = []
+        self._natives = None
+
+    # Native macros are provided by module files (see NATIVE_MODULES), not by the names used to
+    # import them; 'std::list' and 'std/list' import the same file.
+    def natives(self, path):
+        if self._natives is None:
+            self._natives = {}
+            for name, functions in NATIVE_MODULES.items():
+                try:
+                    source_file, _ = find_module(name)
+                except Exception:
+                    continue
+                self._natives[os.path.realpath(source_file)] = functions
+        return { each.native_name: each for each in self._natives.get(path, ()) }
+
+    def import_module(self, name):
+        source_file, status = find_module(name)
+        path = os.path.realpath(source_file)
+
+        namespace = self._namespaces.get(path)
+        if namespace is not None:
+            return namespace
+
+        # a module being imported is skipped when imported again (through a cycle) so it does not
+        # provide anything to modules it imports, directly or not
+        importing_paths = [each[1] for each in self._importing]
+        if path in importing_paths:
+            cycle = [each[0] for each in self._importing[importing_paths.index(path):]] + [name]
+            print('warning: import cycle: {} (skipped)'.format(' -> '.join(cycle)), file = sys.stderr)
+            return collections.ChainMap({})
+
+        self._importing.append((name, path,))
+        try:
+            module = load_module(source_file, status, self._module_cache)
+            namespace = self.namespace(module['imports'], module['macros'], self.natives(path))
+        finally:
+            self._importing.pop()
+
+        self._namespaces[path] = namespace
+        return namespace
+
+    def namespace(self, imports, macros, *base):
+        # tables in the order their definitions are applied, a module's imports before its own
+        # definitions; a table applied again is dropped (the first import of a module wins, as if
+        # later imports of it were skipped)
+        tables = []
+        for each in imports:
+            tables.extend(reversed(self.import_module(each).maps))
+        tables.extend(reversed(base))
+        tables.append(macros)
+
+        unique_tables = []
+        seen = set()
+        for each in tables:
+            if id(each) not in seen:
+                seen.add(id(each))
+                unique_tables.append(each)
+        return collections.ChainMap(*reversed(unique_tables))
 
 
 def parse_elements(tokens):
@@ -545,16 +997,16 @@ def parse_elements(tokens):
     i, limit = 0, len(tokens)
 
     while i < len(tokens):
-        if tokens[i] == '[':
+        if tokens[i].kind == TOKEN_BRACKET_OPEN:
             subsequence = [tokens[i]]
             i += 1
             balance = 1
 
             while i < limit and balance > 0:
                 subsequence.append(tokens[i])
-                if tokens[i] == '[':
+                if tokens[i].kind == TOKEN_BRACKET_OPEN:
                     balance += 1
-                if tokens[i] == ']':
+                if tokens[i].kind == TOKEN_BRACKET_CLOSE:
                     balance -= 1
                 i += 1
 
@@ -563,12 +1015,12 @@ def parse_elements(tokens):
 
             elements.append(parse_elements(subsequence))
 
-            if i < limit and tokens[i] != ',':
+            if i < limit and tokens[i].kind != TOKEN_COMMA:
                 raise InvalidSyntax(tokens[i], 'missing comma')
         else:
             elements.append(tokens[i])
             i += 1
-            if i < limit and tokens[i] != ',':
+            if i < limit and tokens[i].kind != TOKEN_COMMA:
                 raise InvalidSyntax(tokens[i], 'missing comma')
         i += 1
 
@@ -580,74 +1032,169 @@ def parse_parameters_list(tokens):
     i, limit = 0, len(tokens)
 
     while i < len(tokens):
-        if tokens[i] == '...':
-            elements.append(Token(('...' + str(tokens[i+1])), *(tokens[i].position())))
+        if tokens[i].kind == TOKEN_SPREAD:
+            elements.append(Token(('...' + str(tokens[i+1])), *(tokens[i].position()), kind = TOKEN_NAME))
             i += 1
         else:
             elements.append(tokens[i])
         i += 1
-        if i < limit and tokens[i] != ',':
+        if i < limit and tokens[i].kind != TOKEN_COMMA:
             raise InvalidSyntax(tokens[i], 'missing comma')
         i += 1
 
     return elements
 
-def parse_expressions_list(tokens):
+# Expression lists are returned as (start, end) ranges into tokens instead of copies.
+def parse_expressions_list(tokens, start, limit):
     expressions = []
 
-    i, limit = 0, len(tokens)
+    i = start
 
-    part = []
+    part_start = i
     balance = 0
     while i < limit:
-        part.append(tokens[i])
-        if tokens[i] in ('(', '[',):
+        kind = tokens[i].kind
+        if kind == TOKEN_PAREN_OPEN or kind == TOKEN_BRACKET_OPEN:
             balance += 1
-        if tokens[i] in (')', ']',):
+        if kind == TOKEN_PAREN_CLOSE or kind == TOKEN_BRACKET_CLOSE:
             balance -= 1
-        if tokens[i] == ',' and balance == 0:
-            expressions.append(part[:-1])  # push part without trailing ','
-            part = []
+        if kind == TOKEN_COMMA and balance == 0:
+            expressions.append((part_start, i,))  # push part without trailing ','
+            part_start = i + 1
         i += 1
-    if part:
-        expressions.append(part)
+    if part_start < limit:
+        expressions.append((part_start, limit,))
 
     return expressions
 
-def parse_arguments_list(tokens, macros, global_variables, local_variables):
-    arguments = []
+# Node kinds of the expression tree.
+# Macro clauses, target bodies, and 'if' expressions are parsed into trees once, when they are
+# prepared; expansion walks the trees and never looks at tokens again.
+#
+#   (NODE_NEWLINE,)
+#   (NODE_CONSTANT, value)
+#   (NODE_NAME, name, token)
+#   (NODE_SPREAD, expression)
+#   (NODE_CALL, name, (argument, ...), token)
+#   (NODE_BOOLEAN, expression)
+#   (NODE_IF, condition, expression_if_true, expression_if_false)
+NODE_NEWLINE = 0
+NODE_CONSTANT = 1
+NODE_NAME = 2
+NODE_SPREAD = 3
+NODE_CALL = 4
+NODE_BOOLEAN = 5
+NODE_IF = 6
+
+NEWLINE = (NODE_NEWLINE,)
+CONSTANT_TRUE = (NODE_CONSTANT, 'true',)
+CONSTANT_FALSE = (NODE_CONSTANT, 'false',)
+
+# Parse a single expression from the tokens[start:limit] view.
+# Returns index of the first token after the expression, and the expression tree.
+def parse_expression(tokens, start, limit):
+    i = start
+
+    if i >= limit:
+        raise InvalidSyntax(tokens[min(i, len(tokens)) - 1], 'expected an expression')
+
+    each = tokens[i]
+    i += 1
+
+    if each.kind == TOKEN_SPREAD:
+        i, expression = parse_expression(tokens, i, limit)
+        return i, (NODE_SPREAD, expression,)
+    elif i < limit and tokens[i].kind == TOKEN_PAREN_OPEN:
+        i += 1
+        arguments_start = i
+        balance = 1
+        while i < limit and balance > 0:
+            if tokens[i].kind == TOKEN_PAREN_OPEN:
+                balance += 1
+            if tokens[i].kind == TOKEN_PAREN_CLOSE:
+                balance -= 1
+            i += 1
+
+        # strip '(' and ')'
+        # only the first expression of each argument is used
+        arguments = tuple(map(
+            lambda each: parse_expression(tokens, each[0], each[1])[1],
+            parse_expressions_list(tokens, arguments_start, i - 1),
+        ))
+        return i, (NODE_CALL, str(each), arguments, each,)
+    elif each.kind == TOKEN_TRUE:
+        return i, CONSTANT_TRUE
+    elif each.kind == TOKEN_FALSE:
+        return i, CONSTANT_FALSE
+    elif each.kind == TOKEN_BOOLEAN:
+        i, expression = parse_expression(tokens, i, limit)
+        return i, (NODE_BOOLEAN, expression,)
+    elif each.kind == TOKEN_IF:
+        i, condition = parse_expression(tokens, i, limit)
+        while i < limit and tokens[i].kind != TOKEN_ARROW:
+            i += 1
+        i += 1
+        i, expression_if_true = parse_expression(tokens, i, limit)
+        while i < limit and tokens[i].kind != TOKEN_ELSE:
+            i += 1
+        i += 1
+        i, expression_if_false = parse_expression(tokens, i, limit)
+        return i, (NODE_IF, condition, expression_if_true, expression_if_false,)
+    elif each.kind == TOKEN_STRING:
+        return i, (NODE_CONSTANT, String(str(each)[1:-1]),)
+    else:
+        return i, (NODE_NAME, str(each), each,)
+
+# Parse a body: a sequence of expressions, where commas separate steps.
+def parse_body(tokens, start, limit):
+    body = []
 
-    parts = parse_expressions_list(tokens)
+    i = start
 
-    for each in parts:
-        _, value = consume(each, macros, global_variables, local_variables)
-        arguments.extend(value)
+    while i < limit:
+        if tokens[i].kind == TOKEN_COMMA:
+            body.append(NEWLINE)
+            i += 1
+            continue
+        i, expression = parse_expression(tokens, i, limit)
+        body.append(expression)
+
+    return tuple(body)
 
-    return arguments
+def fingerprint_tokens(tokens, start, limit):
+    return hashlib.sha256('\0'.join(map(str, tokens[start:limit])).encode('utf-8')).hexdigest()
 
-def prepare_target(tokens):
+def prepare_target(tokens, start, limit, macros):
     target = {
         'target': None,
         'dependencies': [],
         'variables': {},
         'body': [],
+        'macro': None,
     }
 
-    i, limit = 0, len(tokens)
+    i = start
 
     # skip 'do'
     i += 1
 
     # header runs until first '->'
-    header = []
-    while i < limit and tokens[i] != '->':
-        header.append(tokens[i])
+    header_start = i
+    while i < limit and tokens[i].kind != TOKEN_ARROW:
         i += 1
 
     # strip '(' and ')'
-    header = header[1:-1]
-
-    elements = parse_elements(header)
+    # dependencies which are not a literal list are an expression, expanded when the target is
+    # compiled
+    elements = []
+    for j, (part_start, part_end) in enumerate(parse_expressions_list(tokens, header_start+1, i-1)):
+        if j == 1 and tokens[part_start].kind != TOKEN_BRACKET_OPEN:
+            expression_end, target['dependencies_expression'] = parse_expression(tokens, part_start, part_end)
+            if expression_end < part_end:
+                raise InvalidSyntax(tokens[expression_end], 'missing comma')
+            elements.append([])
+        else:
+            elements.extend(parse_elements(tokens[part_start:part_end]))
 
     target['target'] = elements[0]
     target['dependencies'] = (elements[1] if len(elements) > 1 else [])
@@ -656,23 +1203,26 @@ def prepare_target(tokens):
     i += 1
 
     names = []
-    if tokens[i] != '(':
+    body = None
+    if tokens[i].kind != TOKEN_PAREN_OPEN:
         macro_name = str(tokens[i])
         selected_overload = select_overload(macro_name, macros, elements)
         names = selected_overload['parameters']
         if len(names) != len(elements) and (len(names) and not names[-1].startswith('...')):
             raise Exception(tokens[i], 'invalid number of parameters in macro: {}'.format(macro_name))
-        tokens = tokens[:i] + selected_overload['body']
-        # unskip '->', reuse it as a parameters-from-body separator
-        i -= 1
+        body = selected_overload['body']
+        target['macro'] = macro_name
     else:
-        while i < limit and tokens[i] != '->':
-            names.append(tokens[i])
+        names_start = i
+        while i < limit and tokens[i].kind != TOKEN_ARROW:
             i += 1
 
         # strip '(' and ')'
-        names = names[1:-1]
-        names = list(map(str, parse_elements(names)))
+        names = list(map(str, parse_elements(tokens[names_start+1 : i-1])))
+
+        # skip '->'
+        i += 1
+        body = parse_body(tokens, i, limit-1)  # without final '.'
 
     target['names'] = names
 
@@ -700,92 +1250,92 @@ def prepare_target(tokens):
 
     target['variables'] = variables
 
-    # skip '->'
-    i += 1
-
-    target['body'] = tokens[i:]
+    target['body'] = body
 
     return target
 
-def prepare_macro_clause(tokens):
+def prepare_macro_clause(tokens, start, limit):
     macro = {}
 
-    i, limit = 0, len(tokens)
+    i = start
 
     # skip name
     i += 1
 
-    parameters = []
-    while i < limit and tokens[i] != '->':
-        parameters.append(tokens[i])
+    parameters_start = i
+    while i < limit and tokens[i].kind != TOKEN_ARROW:
         i += 1
 
     # strip '(' and ')'
-    parameters = parameters[1:-1]
-    parameters = tuple(map(str, parse_parameters_list(parameters)))
+    parameters = tuple(map(str, parse_parameters_list(tokens[parameters_start+1 : i-1])))
     macro['parameters'] = parameters
 
     # skip '->'
     i += 1
 
-    macro['body'] = tokens[i:]
+    macro['body'] = parse_body(tokens, i, limit-1)  # without final ';' or '.'
 
     return macro
 
-def split_macro_overloads(tokens):
+def split_macro_overloads(tokens, start, limit):
     overloads = []
 
-    clause = []
-    i, limit = 0, len(tokens)
+    clause_start = start
+    i = start
 
     while i < limit:
-        clause.append(tokens[i])
-        if tokens[i] in (';', '.',):
-            overloads.append(clause)
-            clause = []
+        if tokens[i].kind == TOKEN_SEMICOLON or tokens[i].kind == TOKEN_DOT:
+            overloads.append((clause_start, i + 1,))
+            clause_start = i + 1
         i += 1
 
     return overloads
 
-def prepare_macro(tokens):
+def prepare_macro(tokens, start, limit):
     macro = {
         'name': None,
         'overloads': [],
+        'arities': {},
+        'variadic': (),
+        'fingerprint': fingerprint_tokens(tokens, start, limit),
     }
 
-    i, limit = 0, len(tokens)
+    i = start
 
     # strip 'macro'
     i += 1
 
     macro['name'] = str(tokens[i])
 
-    overloads = split_macro_overloads(tokens[i:])
-    macro['overloads'] = list(map(prepare_macro_clause, overloads))
+    overloads = split_macro_overloads(tokens, i, limit)
+    macro['overloads'] = list(map(lambda each: prepare_macro_clause(tokens, *each), overloads))
+    macro['arities'], macro['variadic'] = prepare_dispatch(macro['overloads'])
 
     return macro
 
 def despecialise(something):
-    if type(something) is Token and str(something)[0] in ('"', "'",):
+    if type(something) is Token and something.kind == TOKEN_STRING:
         return String(str(something)[1:-1])
-    elif type(something) is Token and str(something)[0] not in ('"', "'",):
+    elif type(something) is Token:
         return Atom(str(something))
     elif type(something) is list:
         return List(list(map(despecialise, something)))
     elif type(something) is tuple:
         return Tuple(tuple(map(despecialise, something)))
+    elif isinstance(something, NgmakeType):
+        return something
     else:
         raise TypeError(type(something))
 
-SUBSEQUENCE_TYPES = { '[': list, '(': tuple, }
+SUBSEQUENCE_TYPES = { TOKEN_BRACKET_OPEN: list, TOKEN_PAREN_OPEN: tuple, }
 
-def prepare_variable(tokens):
+def prepare_variable(tokens, start, limit):
     variable = {
         'name': None,
         'value': None,
     }
 
-    i, limit = 0, len(tokens)
+    i = start
 
     # skip 'let'
     i += 1
@@ -793,15 +1343,15 @@ def prepare_variable(tokens):
     variable['name'] = str(tokens[i])
     i += 1
 
-    if tokens[i] != '=':
+    if tokens[i].kind != TOKEN_EQUALS:
         raise InvalidSyntax(tokens[i], 'missing assignment')
 
     # skip '='
     i += 1
 
-    if tokens[i] in ('[', '('):
-        subsequence_type = SUBSEQUENCE_TYPES[str(tokens[i])]
-        subsequence = tokens[i : -1]
+    if tokens[i].kind in SUBSEQUENCE_TYPES:
+        subsequence_type = SUBSEQUENCE_TYPES[tokens[i].kind]
+        subsequence = tokens[i : limit-1]
         i += len(subsequence)
 
         # strip enclosing parentheses
@@ -812,25 +1362,71 @@ def prepare_variable(tokens):
         variable['value'] = despecialise(tokens[i])
         i += 1
 
-    if tokens[i] != '.':
-        raise InvalidSyntax(str(tokens[i]), 'invalid variable declaration ending')
+    if tokens[i].kind != TOKEN_DOT:
+        raise InvalidSyntax(tokens[i], 'invalid variable declaration ending')
 
     return variable
 
 def resolve(something, global_variables, local_variables, *other):
     value = None
-    if something[0] in ('"', "'",):
-        value = String(str(something)[1:-1])
+    name = str(something)
+    if something.kind == TOKEN_STRING:
+        value = String(name[1:-1])
     else:
-        value = local_variables.get(str(something), global_variables.get(str(something)))
+        value = local_variables.get(name)
+        if value is None:
+            value = global_variables.get(name)
         for each in other:
             if value is not None:
                 break
-            value = each.get(str(something))
+            value = each.get(name)
     if value is None:
-        raise Exception(something, 'undefined variable: {}'.format(repr(str(something))))
+        raise Exception(something, 'undefined variable: {}'.format(repr(name)))
     return value
 
+# Chained symbol table used during expansion.
+# Names are looked up in local variables (macro parameters or target bindings), then in global
+# variables, and then in the macro table; a macro name resolves to itself so it can be passed
+# around and called later.
+# Child scopes share everything except local variables.
+# Lookups that go past local variables are reported to the dependency tracker, if there is one.
+class Scope:
+    __slots__ = ('local_variables', 'global_variables', 'macros', 'cache', 'tracker', 'profiler',)
+
+    def __init__(self, local_variables, global_variables, macros, cache = None, tracker = None, profiler = None):
+        self.local_variables = local_variables
+        self.global_variables = global_variables
+        self.macros = macros
+        self.cache = cache
+        self.tracker = tracker
+        self.profiler = profiler
+
+    def child(self, local_variables):
+        return Scope(local_variables, self.global_variables, self.macros, self.cache, self.tracker, self.profiler)
+
+    def variable(self, name):
+        value = self.local_variables.get(name)
+        if value is None:
+            if self.tracker is not None:
+                self.tracker.variable(name)
+            value = self.global_variables.get(name)
+        return value
+
+    def resolve(self, name, token):
+        value = self.local_variables.get(name)
+        if value is not None:
+            return value
+        if self.tracker is not None:
+            self.tracker.variable(name)
+        value = self.global_variables.get(name)
+        if value is not None:
+            return value
+        if self.tracker is not None:
+            self.tracker.macro(name)
+        if name in self.macros:
+            return name
+        raise Exception(token, 'undefined variable: {}'.format(repr(name)))
+
 def compile_header(source, global_variables):
     target = {
         'variables': source['variables'],
@@ -842,20 +1438,44 @@ def compile_header(source, global_variables):
 
     return target
 
-def select_clause(arguments, available_clauses):
-    selected_overload = None
-    for clause in available_clauses:
-        parameters_length = len(clause['parameters'])
-        mismatched_lengths = parameters_length != len(arguments)
-        last_parameter_packs = bool(parameters_length and str(clause['parameters'][-1]).startswith('...'))
-        arguments_can_be_packed = ((len(arguments) >= (parameters_length-1)) and last_parameter_packs)
-        if len(arguments) == 0 and parameters_length == 1 and last_parameter_packs:
-            arguments_can_be_packed = True
-
-        if mismatched_lengths and not arguments_can_be_packed:
-            continue
-        selected_overload = clause
-        break
+def clause_matches(clause, arity):
+    parameters_length = len(clause['parameters'])
+    if parameters_length == arity:
+        return True
+    last_parameter_packs = bool(parameters_length and clause['parameters'][-1].startswith('...'))
+    return (arity >= (parameters_length-1)) and last_parameter_packs
+
+# Precompile clause dispatch for a macro.
+# Every arity up to the largest fixed arity maps directly to the first clause matching it;
+# larger arities can only be matched by variadic clauses, which are kept in definition order
+# together with their minimum arity.
+def prepare_dispatch(overloads):
+    variadic = []
+    largest_fixed_arity = -1
+    for clause in overloads:
+        parameters = clause['parameters']
+        if parameters and parameters[-1].startswith('...'):
+            variadic.append((len(parameters) - 1, clause,))
+        else:
+            largest_fixed_arity = max(largest_fixed_arity, len(parameters))
+
+    arities = {}
+    for arity in range(largest_fixed_arity + 1):
+        for clause in overloads:
+            if clause_matches(clause, arity):
+                arities[arity] = clause
+                break
+
+    return arities, tuple(variadic)
+
+def select_clause(arguments, macro):
+    arity = len(arguments)
+    selected_overload = macro['arities'].get(arity)
+    if selected_overload is None:
+        for minimum_arity, clause in macro['variadic']:
+            if arity >= minimum_arity:
+                selected_overload = clause
+                break
     return selected_overload
 
 def select_overload(macro_name, macros, arguments):
@@ -869,193 +1489,1856 @@ def select_overload(macro_name, macros, arguments):
         raise Exception('could not find matching macro: {}'.format(macro_name))
     return selected_overload
 
-def consume(tokens, macros, global_variables, local_variables):
-    value = []
+# Cache of macro expansions.
+# Macros are referentially transparent (no I/O, immutable variables) so an expansion is fully
+# determined by the name of the macro and values of its arguments, and can be reused.
+# Python callables in the macro table opt in by setting their 'pure' attribute to True.
+# Every entry also keeps the names the expansion depended on (see DependencyTracker).
+class ExpansionCache:
+    def __init__(self, size = 4096, key_size_limit = 64):
+        self._size = size
+        self._key_size_limit = key_size_limit
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return list(entry[0]), entry[1]
+
+    # Keys are built only for reasonably small argument lists; building a key costs as much
+    # as copying the arguments, and long lists (e.g. recursion over all dependencies of a target)
+    # are unlikely to be expanded with the same values again.
+    def key(self, macro_name, arguments):
+        size = len(arguments)
+        if size > self._key_size_limit:
+            return None
+        for each in arguments:
+            if type(each) is list:
+                size += len(each)
+        if size > self._key_size_limit:
+            return None
+        return (macro_name, ExpansionCache.freeze(arguments),)
+
+    def put(self, key, value, dependencies = None):
+        if self._size <= 0:
+            return
+        self._entries[key] = (list(value), dependencies,)
+        if len(self._entries) > self._size:
+            self._entries.popitem(last = False)
+
+    @staticmethod
+    def freeze(value):
+        t = type(value)
+        if t is str:
+            return value
+        elif t is list or t is tuple:
+            return (t, tuple(map(ExpansionCache.freeze, value)),)
+        elif isinstance(value, NgmakeType):
+            return (t, ExpansionCache.freeze(value._value),)
+        else:
+            return (t, value,)
+
+    @staticmethod
+    def cacheable(available_clauses):
+        return (type(available_clauses) is dict) or bool(getattr(available_clauses, 'pure', False))
+
+# Expansion engine.
+# Evaluation of every expression that needs values of other expressions is written as a generator;
+# it yields a generator evaluating the subexpression and receives its value back.
+# The generators are driven by run() from an explicit stack, so recursion depth of Ngmake macros
+# is limited only by available memory, not by the Python stack.
+def run(generator):
+    stack = [generator]
+    value = None
+    while True:
+        try:
+            generator = stack[-1].send(value)
+        except StopIteration as e:
+            stack.pop()
+            if not stack:
+                return e.value
+            value = e.value
+            continue
+        stack.append(generator)
+        value = None
+
+def boolean_value(result):
+    if repr(result) == repr('true'):
+        return 'true'
+    elif repr(result) == repr('false'):
+        return 'false'
+    elif str(result):
+        return 'true'
+    else:
+        return 'false'
+
+# Expand a macro with already evaluated arguments.
+# Python callables in the macro table are called with the arguments and return the value directly,
+# unless their 'expands' attribute is True; such callables expand other macros, so they are called
+# with the scope before the arguments and return a generator driven by the expansion engine.
+def call_macro(macro_name, arguments, scope):
+    macros = scope.macros
+
+    tracker = scope.tracker
+    if tracker is not None:
+        tracker.macro(macro_name)
+
+    profiler = scope.profiler
+    if profiler is not None:
+        profiler.enter(macro_name)
+
+    cache = scope.cache
+    cache_key = None
+    if cache is not None and ExpansionCache.cacheable(macros.get(macro_name)):
+        cache_key = cache.key(macro_name, arguments)
+        if cache_key is not None:
+            entry = cache.get(cache_key)
+            if entry is not None:
+                value, dependencies = entry
+                if tracker is not None:
+                    tracker.merge(dependencies)
+                if profiler is not None:
+                    profiler.leave(macro_name, None, macros)
+                return value
+            if tracker is not None:
+                tracker.begin()
+
+    selected_overload = select_overload(macro_name, macros, arguments)
+    if callable(selected_overload):
+        if getattr(selected_overload, 'expands', False):
+            value = yield selected_overload(scope, *arguments)
+        elif getattr(selected_overload, 'scoped', False):
+            value = selected_overload(scope, *arguments)
+        else:
+            value = selected_overload(*arguments)
+    else:
+        macro_parameters = {}
+        for j, param in enumerate(selected_overload['parameters']):
+            if param.startswith('...'):
+                param = param[3:]
+                macro_parameters[param] = arguments[j:]
+            else:
+                macro_parameters[param] = arguments[j]
+
+        # arguments are bound to parameters now; do not keep them alive during
+        # (possibly deeply recursive) expansion of the body
+        arguments = None
+
+        value = yield evaluate_body(selected_overload['body'], scope.child(macro_parameters))
+
+    if cache_key is not None:
+        cache.put(cache_key, value, (tracker.end() if tracker is not None else None))
+    if profiler is not None:
+        profiler.leave(macro_name, selected_overload, macros)
+    return value
 
-    i, limit = 0, len(tokens)
+# Evaluate a single expression tree.
+# Returns the value of the expression, which is always a list.
+def evaluate_expression(node, scope):
+    value = []
 
-    each = tokens[i]
-    i += 1
+    kind = node[0]
 
-    if each == '...':
-        skip, subvalue = consume(tokens[i:], macros, global_variables, local_variables)
-        i += skip
+    if kind == NODE_CONSTANT:
+        value.append(node[1])
+    elif kind == NODE_NAME:
+        value.append(scope.resolve(node[1], node[2]))
+    elif kind == NODE_SPREAD:
+        subvalue = yield evaluate_expression(node[1], scope)
         value.extend(subvalue[0])
-    elif i < limit and tokens[i] == '(':
-        macro_name = str(each)
-        if macro_name not in macros:
-            macro_name = str(local_variables.get(macro_name, global_variables.get(macro_name)) or macro_name)
+    elif kind == NODE_CALL:
+        macro_name = node[1]
+        if macro_name not in scope.macros:
+            if scope.tracker is not None:
+                scope.tracker.macro(macro_name)
+            macro_name = str(scope.variable(macro_name) or macro_name)
+
+        subsequence = []
+        for each in node[2]:
+            if each[0] == NODE_CONSTANT:
+                subsequence.append(each[1])
+            elif each[0] == NODE_NAME:
+                subsequence.append(scope.resolve(each[1], each[2]))
+            else:
+                subsequence.extend((yield evaluate_expression(each, scope)))
+
+        value = yield from call_macro(macro_name, subsequence, scope)
+    elif kind == NODE_BOOLEAN:
+        result = yield evaluate_expression(node[1], scope)
+        value.append(boolean_value(result[0] if result else 'false'))
+    elif kind == NODE_IF:
+        # only the selected branch is expanded
+        value = yield evaluate_expression(node[1], scope)
+        if value and str(value[0]) == 'true':
+            value = yield evaluate_expression(node[2], scope)
+        else:
+            value = yield evaluate_expression(node[3], scope)
 
-        if i == len(tokens) or tokens[i] != '(':
-            raise InvalidSyntax(tokens[i-1], 'missing opening parentheses')
+    return value
 
-        subsequence = [tokens[i]]
-        i += 1
-        balance = 1
-        while i < limit and balance > 0:
-            subsequence.append(tokens[i])
-            if tokens[i] == '(':
-                balance += 1
-            if tokens[i] == ')':
-                balance -= 1
-            i += 1
+def evaluate_body(nodes, scope):
+    body = []
 
-        # strip '(' and ')'
-        subsequence = subsequence[1:-1]
-        subsequence = parse_arguments_list(subsequence, macros, global_variables, local_variables)
+    for node in nodes:
+        kind = node[0]
+        if kind == NODE_NEWLINE:
+            body.append('\n')
+        elif kind == NODE_CONSTANT:
+            body.append(node[1])
+        elif kind == NODE_NAME:
+            body.append(scope.resolve(node[1], node[2]))
+        else:
+            body.extend((yield evaluate_expression(node, scope)))
 
-        selected_overload = select_overload(macro_name, macros, subsequence)
-        if callable(selected_overload):
-            value = selected_overload(*subsequence)
+    return body
+
+def evaluate(node, scope):
+    return run(evaluate_expression(node, scope))
+
+def flatten_dependencies(values):
+    for each in values:
+        if type(each) is list or type(each) is tuple:
+            yield from flatten_dependencies(each)
+        elif isinstance(each, (List, Tuple,)):
+            yield from flatten_dependencies(each._value)
         else:
-            macro_parameters = {}
-            for j, param in enumerate(selected_overload['parameters']):
-                if param.startswith('...'):
-                    param = param[3:]
-                    macro_parameters[param] = subsequence[j:]
-                else:
-                    macro_parameters[param] = subsequence[j]
-
-            compiled = compile_body({}, selected_overload, global_variables, macros, macro_parameters)
-            value = compiled['body']
-    elif each == 'true':
-        value.append('true')
-    elif each == 'false':
-        value.append('false')
-    elif each == 'boolean':
-        skip, result = consume(tokens[i:], macros, global_variables, local_variables)
-        i += skip
-        if result:
-            result = result[0]
+            yield String(str(each))
+
+# Expand the expression giving dependencies of a target, and bind them to the parameter for
+# dependencies (the second one, or the second element of a variadic first one) like a literal list
+# would be bound.
+def compile_dependencies(target, source, scope):
+    target['dependencies'] = list(flatten_dependencies(evaluate(source['dependencies_expression'], scope)))
+    names = source['names']
+    value = list(map(str, target['dependencies']))
+    if names and names[0].startswith('...'):
+        scope.local_variables[names[0][3:]][1] = value
+    elif len(names) > 1:
+        if names[1].startswith('...'):
+            scope.local_variables[names[1][3:]][0] = value
         else:
-            result = 'false'
-        if repr(result) == repr('true'):
-            value.append('true')
-        elif repr(result) == repr('false'):
-            value.append('false')
-        elif str(result):
-            value.append('true')
+            scope.local_variables[names[1]] = value
+    return target
+
+def compile_body(target, source, scope):
+    target['body'] = run(evaluate_body(source['body'], scope))
+    return target
+
+# Native implementations of macros from the standard library.
+# They replace recursive macros that needed quadratic (or worse) time, and produce exactly the
+# values the macros did. They are layered below the macros of the module that provides them
+# (see NATIVE_MODULES) so they can be shadowed like any other macro.
+# Native macros that expand other macros by fixed names list the names in 'calls'.
+# Native macros that only need the scope (but do not expand anything) are 'scoped'.
+def native(name, expands = False, calls = (), scoped = False):
+    def decorator(function):
+        function.native_name = name
+        function.pure = True
+        function.expands = expands
+        function.calls = calls
+        function.scoped = scoped
+        return function
+    return decorator
+
+def no_matching_macro(name):
+    return Exception('could not find matching macro: {}'.format(name))
+
+@native('gather')
+def std_list_gather(*arguments):
+    return [list(arguments)]
+
+@native('reverse')
+def std_list_reverse(*arguments):
+    if not arguments:
+        raise no_matching_macro('reverse')
+    return [list(reversed(arguments))]
+
+@native('head')
+def std_list_head(*arguments):
+    if not arguments:
+        raise no_matching_macro('head')
+    return [arguments[0]]
+
+@native('tail')
+def std_list_tail(*arguments):
+    if not arguments:
+        raise no_matching_macro('tail')
+    return [list(arguments[1:])]
+
+# The predicate is applied to the conjunction of all elements (computed using the 'and' macro),
+# not to each element.
+@native('all', expands = True, calls = ('and',))
+def std_list_all(scope, *arguments):
+    if len(arguments) < 2:
+        return ['true']
+    pred = str(arguments[0])
+    pending = collections.deque(arguments[1:])
+    while len(pending) > 1:
+        first, second = pending.popleft(), pending.popleft()
+        pending.extendleft(reversed((yield from call_macro('and', [first, second], scope))))
+    if not pending:
+        return ['true']
+    return (yield from call_macro(pred, [pending[0]], scope))
+
+@native('filter', expands = True)
+def std_list_filter(scope, *arguments):
+    if len(arguments) < 2:
+        raise no_matching_macro('filter')
+    pred = str(arguments[0])
+    selected = []
+    for each in arguments[1:]:
+        condition = yield from call_macro(pred, [each], scope)
+        if condition and str(condition[0]) == 'true':
+            selected.append(each)
+    return [selected]
+
+@native('and')
+def std_bool_and(*arguments):
+    if len(arguments) != 2:
+        raise no_matching_macro('and')
+    lhs, rhs = arguments
+    return [(boolean_value(rhs) if str(lhs) == 'true' else 'false')]
+
+@native('or')
+def std_bool_or(*arguments):
+    if len(arguments) != 2:
+        raise no_matching_macro('or')
+    lhs, rhs = arguments
+    return [('true' if str(lhs) == 'true' else boolean_value(rhs))]
+
+@native('not')
+def std_bool_not(*arguments):
+    if len(arguments) != 1:
+        raise no_matching_macro('not')
+    return [('false' if boolean_value(arguments[0]) == 'true' else 'true')]
+
+# Builtin macros available in every Ngmakefile.
+# Regular expressions are compiled once per pattern.
+compiled_patterns = {}
+
+def compile_pattern(pattern):
+    pattern = str(pattern)
+    compiled = compiled_patterns.get(pattern)
+    if compiled is None:
+        compiled = compiled_patterns[pattern] = re.compile(pattern)
+    return compiled
+
+@native('match')
+def std_match_regex(s, pat):
+    result = [('true' if compile_pattern(pat).match(str(s)) else 'false')]
+    return result
+
+@native('select_matching')
+def std_select_matching(*arguments):
+    if not arguments:
+        raise no_matching_macro('select_matching')
+    match = compile_pattern(arguments[0]).match
+    return [[each for each in arguments[1:] if match(str(each))]]
+
+@native('reject_matching')
+def std_reject_matching(*arguments):
+    if not arguments:
+        raise no_matching_macro('reject_matching')
+    match = compile_pattern(arguments[0]).match
+    return [[each for each in arguments[1:] if not match(str(each))]]
+
+@native('substitute')
+def std_substitute(*arguments):
+    if len(arguments) < 2:
+        raise no_matching_macro('substitute')
+    sub = compile_pattern(arguments[0]).sub
+    replacement = str(arguments[1])
+    return [[String(sub(replacement, str(each))) for each in arguments[2:]]]
+
+# Listings of directories read by glob().
+# Every directory is listed once per run (later listings are served from memory), so overlapping
+# patterns never read a directory again. Listings can be saved and loaded in the next run, where a
+# saved listing is used if modification time of its directory did not change; listings read less
+# than a second after the directory was modified are not saved, as the directory could change again
+# without changing its (possibly coarse) modification time. Saved listings of directories a run did
+# not visit are saved again if they are still valid.
+# Workers compiling targets in parallel report listings they read to the main process, which saves
+# the index.
+GLOB_INDEX_VERSION = 1
+
+class DirectoryIndex:
+    def __init__(self):
+        self._listings = {}
+        self._current = set()
+        self._racy = set()
+        self._reported = set()
+
+    def load(self, path):
+        index = load_pickle(path)
+        if type(index) is dict and index.get('version') == GLOB_INDEX_VERSION:
+            self._listings = index['listings']
+
+    def save(self, path):
+        listings = {}
+        for directory, entry in self._listings.items():
+            if entry is None or directory in self._racy:
+                continue
+            if directory not in self._current:
+                try:
+                    if os.stat(directory or '.').st_mtime_ns != entry[0]:
+                        continue
+                except OSError:
+                    continue
+            listings[directory] = entry
+        store_pickle(path, {
+            'version': GLOB_INDEX_VERSION,
+            'listings': listings,
+        })
+
+    # Listings read since the last call, for merging into the index of another process.
+    def take_listed(self):
+        listed = { each: (self._listings[each], (each in self._racy),) for each in (self._current - self._reported) }
+        self._reported.update(listed)
+        return listed
+
+    def merge(self, listed):
+        for directory, (entry, racy) in listed.items():
+            if directory in self._current:
+                continue
+            self._current.add(directory)
+            self._listings[directory] = entry
+            if racy:
+                self._racy.add(directory)
+
+    # Listing of a directory is a dictionary mapping names of its entries to (is_directory,
+    # is_symbolic_link); None if there is no such directory.
+    def listing(self, directory):
+        if directory in self._current:
+            entry = self._listings.get(directory)
+            return (None if entry is None else entry[1])
+        self._current.add(directory)
+
+        try:
+            mtime = os.stat(directory or '.').st_mtime_ns
+            entry = self._listings.get(directory)
+            if entry is None or entry[0] != mtime:
+                listed_at = time.time_ns()
+                with os.scandir(directory or '.') as entries:
+                    entry = (mtime, { each.name: (each.is_dir(), each.is_symlink(),) for each in entries },)
+                if listed_at - mtime < 1000000000:
+                    self._racy.add(directory)
+        except OSError:
+            entry = None
+        self._listings[directory] = entry
+        return (None if entry is None else entry[1])
+
+    def glob(self, pattern):
+        components = pattern.split('/')
+        root = ''
+        if pattern.startswith('/'):
+            root, components = '/', components[1:]
+        components = [each for each in components if each]
+        found = []
+        self._match(root, components, 0, found)
+        return sorted(set(found))
+
+    def _match(self, directory, components, i, found):
+        if i == len(components):
+            if directory:
+                found.append(directory)
+            return
+        listing = self.listing(directory)
+        if listing is None:
+            return
+        component = components[i]
+        last = (i + 1 == len(components))
+        if component == '**':
+            self._match(directory, components, i + 1, found)
+            for name, (is_directory, is_symbolic_link) in listing.items():
+                if name.startswith('.'):
+                    continue
+                if last:
+                    found.append(os.path.join(directory, name))
+                if is_directory and not is_symbolic_link:
+                    self._match(os.path.join(directory, name), components, i, found)
+        elif component == '.' or component == '..':
+            self._match(os.path.join(directory, component), components, i + 1, found)
+        elif not any((c in component) for c in '*?['):
+            if component in listing and (last or listing[component][0]):
+                self._match(os.path.join(directory, component), components, i + 1, found)
         else:
-            value.append('false')
-    elif each == 'if':
-        skip, value = consume(tokens[i:], macros, global_variables, local_variables)
-        i += skip
-        if value and str(value[0]) == 'true':
-            while i < limit and tokens[i] != '->':
-                i += 1
-            i += 1
-            skip, value = consume(tokens[i:], macros, global_variables, local_variables)
-            i += skip
-            while i < limit and tokens[i] != 'else':
-                i += 1
-            i += 1
-            skip, _ = consume(tokens[i:], macros, global_variables, local_variables)
-            i += skip
+            hidden = component.startswith('.')
+            for name, (is_directory, _) in listing.items():
+                if name.startswith('.') and not hidden:
+                    continue
+                if (last or is_directory) and fnmatch.fnmatchcase(name, component):
+                    self._match(os.path.join(directory, name), components, i + 1, found)
+
+directory_index = DirectoryIndex()
+
+@native('glob', scoped = True)
+def std_glob(scope, *patterns):
+    paths = set()
+    for pattern in map(str, patterns):
+        if scope.tracker is not None:
+            scope.tracker.glob(pattern)
+        paths.update(directory_index.glob(pattern))
+    return [list(map(String, sorted(paths)))]
+
+# Scanner of #include directives in C and C++ files.
+# Directives of every file are read once per run; files found on the same level of inclusion are
+# read in a pool of threads (a pool is started only when there are enough of them to pay for it).
+# Directives can be saved and loaded in the next run, where saved directives of a file are used if
+# its modification time and size did not change; saved directives of files a run did not need are
+# saved again if they are still valid. Workers compiling targets in parallel report directives they
+# read to the main process, which saves the cache. Every header name is resolved once per run for the
+# same directory of the including file and include directories, and the list of headers a file
+# includes directly is kept for the same include directories.
+INCLUDE_CACHE_VERSION = 1
+INCLUDE_SCAN_POOL_THRESHOLD = 8
+
+include_directive_regex = re.compile(rb'^[ \t]*#[ \t]*include[ \t]*([<"])([^>"\n]+)[>"]', re.MULTILINE)
+
+class IncludeScanner:
+    def __init__(self):
+        self._known = {}
+        self._scanned = {}
+        self._resolved = {}
+        self._exists = {}
+        self._children = {}
+        self._reported = set()
+
+    def load(self, path):
+        cache = load_pickle(path)
+        if type(cache) is dict and cache.get('version') == INCLUDE_CACHE_VERSION:
+            self._known = cache['files']
+
+    def save(self, path):
+        files = {}
+        for each, known in self._known.items():
+            if each in self._scanned:
+                continue
+            try:
+                status = os.stat(each)
+            except OSError:
+                continue
+            if known[:2] == (status.st_mtime_ns, status.st_size,):
+                files[each] = known
+        files.update((each, scanned) for each, scanned in self._scanned.items() if scanned is not None)
+        store_pickle(path, {
+            'version': INCLUDE_CACHE_VERSION,
+            'files': files,
+        })
+
+    # Directives read since the last call, for merging into the scanner of another process.
+    def take_scanned(self):
+        scanned = { each: self._scanned[each] for each in (self._scanned.keys() - self._reported) }
+        self._reported.update(scanned)
+        return scanned
+
+    def merge(self, scanned):
+        for each, directives in scanned.items():
+            self._scanned.setdefault(each, directives)
+
+    # Directives of a file are (mtime, size, ((quoted, name), ...)); None if the file cannot be
+    # read. Runs in threads of the pool, so it only reads the tables.
+    def _read(self, path):
+        try:
+            status = os.stat(path)
+            known = self._known.get(path)
+            if known is not None and known[:2] == (status.st_mtime_ns, status.st_size,):
+                return known
+            with open(path, 'rb') as ifstream:
+                contents = ifstream.read()
+        except OSError:
+            return None
+        return (status.st_mtime_ns, status.st_size, tuple(
+            (quote == b'"', name.strip().decode('utf-8', 'surrogateescape'),)
+            for quote, name in include_directive_regex.findall(contents)
+        ),)
+
+    def _scan(self, paths):
+        pending = [each for each in paths if each not in self._scanned]
+        if len(pending) < INCLUDE_SCAN_POOL_THRESHOLD:
+            results = map(self._read, pending)
         else:
-            while i < limit and tokens[i] != '->':
-                i += 1
-            i += 1
-            skip, _ = consume(tokens[i:], macros, global_variables, local_variables)
-            i += skip
-            while i < limit and tokens[i] != 'else':
-                i += 1
-            i += 1
-            skip, value = consume(tokens[i:], macros, global_variables, local_variables)
-            i += skip
-    else:
-        value.append(resolve(each, global_variables, local_variables, dict({ k:k for k in macros })))
-
-    return i, value
+            with concurrent.futures.ThreadPoolExecutor(os.cpu_count() or 1) as pool:
+                results = list(pool.map(self._read, pending))
+        for path, each in zip(pending, results):
+            self._scanned[path] = each
+
+    def _resolve(self, directory, name, include_directories):
+        key = (directory, name, include_directories,)
+        if key in self._resolved:
+            return self._resolved[key]
+        found = None
+        for each in (((directory,) if directory is not None else ()) + include_directories):
+            path = os.path.normpath(os.path.join(each, name))
+            exists = self._exists.get(path)
+            if exists is None:
+                exists = self._exists[path] = os.path.isfile(path)
+            if exists:
+                found = path
+                break
+        self._resolved[key] = found
+        return found
+
+    # Headers a file includes directly.
+    def _included(self, path, include_directories):
+        key = (path, include_directories,)
+        children = self._children.get(key)
+        if children is None:
+            scanned = self._scanned[path]
+            directory = os.path.dirname(path)
+            children = self._children[key] = tuple(filter(None, (
+                self._resolve((directory if quoted else None), name, include_directories)
+                for quoted, name in (scanned[2] if scanned is not None else ())
+            )))
+        return children
+
+    def includes(self, source, include_directories):
+        headers = []
+        seen = set((source,))
+        pending = [source]
+        while pending:
+            self._scan(pending)
+            found = []
+            for path in pending:
+                for header in self._included(path, include_directories):
+                    if header not in seen:
+                        seen.add(header)
+                        found.append(header)
+            headers.extend(found)
+            pending = found
+        return headers
+
+include_scanner = IncludeScanner()
+
+@native('includes', scoped = True)
+def std_includes(scope, *arguments):
+    if not arguments:
+        raise no_matching_macro('includes')
+    source = str(arguments[0])
+    include_directories = tuple(map(str, flatten_dependencies(arguments[1:])))
+    if scope.tracker is not None:
+        scope.tracker.includes(source, include_directories)
+    return [list(map(String, include_scanner.includes(source, include_directories)))]
+
+BUILTINS = (
+    std_match_regex,
+    std_select_matching,
+    std_reject_matching,
+    std_substitute,
+    std_glob,
+    std_includes,
+)
+
+def builtin_macros():
+    return { each.native_name: each for each in BUILTINS }
+
+NATIVE_MODULES = {
+    'std::list': (
+        std_list_gather,
+        std_list_reverse,
+        std_list_head,
+        std_list_tail,
+        std_list_all,
+        std_list_filter,
+    ),
+    'std::bool': (
+        std_bool_and,
+        std_bool_or,
+        std_bool_not,
+    ),
+}
+
+def target_name(tokens, start, limit):
+    return str(tokens[start+2])[1:-1]
+
+# Indexes of targets matching any of the names or shell-style patterns, in source order.
+def select_targets(statements, patterns):
+    index = {}
+    for each in statements.kinds[TOKEN_DO]:
+        index.setdefault(statements.name(each), []).append(each)
+
+    selected = set()
+    for pattern in patterns:
+        if any((c in pattern) for c in '*?['):
+            for name, each in index.items():
+                if fnmatch.fnmatchcase(name, pattern):
+                    selected.update(each)
+        else:
+            selected.update(index.get(pattern, ()))
+
+    return sorted(selected)
+
+def token_names(tokens, start, limit):
+    for each in tokens[start:limit]:
+        if each.kind == TOKEN_STRING:
+            yield str(each)[1:-1]
+        elif each.kind == TOKEN_NAME:
+            yield str(each)
+
+def node_names(nodes):
+    for node in nodes:
+        kind = node[0]
+        if kind == NODE_CONSTANT:
+            yield str(node[1])
+        elif kind == NODE_NAME:
+            yield node[1]
+        elif kind == NODE_CALL:
+            yield node[1]
+            yield from node_names(node[2])
+        elif kind != NODE_NEWLINE:
+            yield from node_names(node[1:])
+
+# Prepare only the macros and variables of the source file that expansion of the given statements
+# can reach.
+# Macros and variables can be passed around and then called (or referenced) by name, so every name
+# and string in reached code, including bodies of imported macros, is treated as a possible
+# reference; this over-approximates but never misses a definition expansion could use.
+# Later definitions take precedence, as they do when all statements are prepared.
+def prepare_reachable(statements, roots, imported_macros):
+    macro_statements = statements.index(TOKEN_MACRO)
+    variable_statements = statements.index(TOKEN_LET)
+    macros = {}
+    variables = {}
 
-def compile_body(target, source, global_variables, macros, local_variables):
-    tokens = source['body'][:-1]  # without final '.'
-    body = []
+    pending = []
+    for each in roots:
+        pending.extend(token_names(*statements.statement(each)))
 
-    i, limit = 0, len(tokens)
+    seen = set()
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
 
-    while i < limit:
-        skip = limit
-        value = []
-        if tokens[i] == ',':
-            value.append('\n')
-            skip = 1
+        if name in macro_statements:
+            macro = macros[name] = prepare_macro(*statements.statement(macro_statements[name]))
         else:
-            skip, value = consume(tokens[i:], macros, global_variables, local_variables)
-        i += skip
-        body.extend(value)
-
-    target['body'] = body
-    return target
-
-def compile(source, global_variables, macros):
+            macro = imported_macros.get(name)
+        if type(macro) is dict:
+            for clause in macro['overloads']:
+                pending.extend(node_names(clause['body']))
+        elif macro is not None:
+            pending.extend(getattr(macro, 'calls', ()))
+
+        if name in variable_statements:
+            variables[name] = prepare_variable(*statements.statement(variable_statements[name]))['value']
+            pending.extend(token_names(*statements.statement(variable_statements[name])))
+
+    return macros, variables
+
+# Names an expansion depended on: macros it expanded and global variables it referenced,
+# including those that were looked up but not defined.
+# Frames nest like macro expansions, so that dependencies of a single cached expansion can be stored
+# in the expansion cache together with its value and replayed when the value is reused.
+class DependencyTracker:
+    def __init__(self):
+        self._frames = [set()]
+
+    def macro(self, name):
+        self._frames[-1].add(('macro', name,))
+
+    def variable(self, name):
+        self._frames[-1].add(('variable', name,))
+
+    def glob(self, pattern):
+        self._frames[-1].add(('glob', pattern,))
+
+    def includes(self, source, include_directories):
+        self._frames[-1].add(('includes', '\0'.join((source,) + include_directories),))
+
+    def merge(self, dependencies):
+        self._frames[-1].update(dependencies)
+
+    def begin(self):
+        self._frames.append(set())
+
+    def end(self):
+        dependencies = frozenset(self._frames.pop())
+        self._frames[-1].update(dependencies)
+        return dependencies
+
+    def dependencies(self):
+        return self._frames[0]
+
+# Fingerprints of current definitions of macros and global variables (None for undefined names).
+# Macros defined in Ngmake are fingerprinted by their tokens, native macros by their names (their
+# code is covered by the fingerprint of the compiler), variables by their values, and glob patterns
+# and scans of #include directives by the paths they found.
+class Fingerprints:
+    def __init__(self, macros, global_variables):
+        self._macros = macros
+        self._global_variables = global_variables
+        self._known = {}
+
+    def of(self, kind, name):
+        key = (kind, name,)
+        if key in self._known:
+            return self._known[key]
+
+        fingerprint = None
+        if kind == 'macro':
+            macro = self._macros.get(name)
+            if type(macro) is dict:
+                fingerprint = macro['fingerprint']
+            elif macro is not None:
+                fingerprint = 'native:{}'.format(getattr(macro, 'native_name', macro.__name__))
+        elif kind == 'glob':
+            fingerprint = hashlib.sha256('\0'.join(directory_index.glob(name)).encode('utf-8')).hexdigest()
+        elif kind == 'includes':
+            source, *include_directories = name.split('\0')
+            headers = include_scanner.includes(source, tuple(include_directories))
+            fingerprint = hashlib.sha256('\0'.join(headers).encode('utf-8')).hexdigest()
+        else:
+            value = self._global_variables.get(name)
+            if value is not None:
+                fingerprint = hashlib.sha256(repr(value).encode('utf-8')).hexdigest()
+
+        self._known[key] = fingerprint
+        return fingerprint
+
+def compiler_fingerprint():
+    return hashlib.sha256(read_bytes(os.path.abspath(__file__))).hexdigest()
+
+# State of incremental compilation, kept in a file between runs.
+# Targets are keyed by fingerprints of their tokens; for every target the state holds its rule and
+# fingerprints of the macros and global variables its expansion depended on.
+# A rule is reused only if all these fingerprints are still the same. The whole state is discarded
+# when the compiler (or the backend) changes.
+INCREMENTAL_STATE_VERSION = 1
+
+class IncrementalState:
+    def __init__(self, path, fingerprints, backend = 'make'):
+        self._path = path
+        self._fingerprints = fingerprints
+        self._compiler = '{}:{}'.format(backend, compiler_fingerprint())
+        self._previous = {}
+        self._current = {}
+        self.reused = 0
+        self.expanded = 0
+
+        state = load_pickle(path)
+        if (type(state) is dict and
+                state.get('version') == INCREMENTAL_STATE_VERSION and
+                state.get('compiler') == self._compiler):
+            self._previous = state['targets']
+
+    def reuse(self, key):
+        record = self._previous.get(key)
+        if record is None:
+            return None
+        for kind, name, fingerprint in record['dependencies']:
+            if self._fingerprints.of(kind, name) != fingerprint:
+                return None
+        self._current[key] = record
+        self.reused += 1
+        return record
+
+    def record(self, key, name, dependencies, rule):
+        self._current[key] = {
+            'name': name,
+            'dependencies': tuple(
+                (kind, each, self._fingerprints.of(kind, each),)
+                for kind, each in sorted(dependencies)
+            ),
+            'rule': rule,
+        }
+        self.expanded += 1
+
+    # Records of targets that were not compiled in this run are kept only if asked to (e.g. when
+    # only some of the targets were selected).
+    def save(self, keep_previous = False):
+        targets = self._current
+        if keep_previous:
+            targets = dict(self._previous)
+            targets.update(self._current)
+        store_pickle(self._path, {
+            'version': INCREMENTAL_STATE_VERSION,
+            'compiler': self._compiler,
+            'targets': targets,
+        })
+
+# Peak resident set size since the previous call, or None if the system does not report it.
+# The high-water mark kept by Linux is reset after reading it, so every call reports the peak since
+# the previous one (getrusage() reports the peak of the whole process instead).
+def peak_memory_use():
+    try:
+        with open('/proc/self/status') as ifstream:
+            peak = next((line.split()[1] for line in ifstream if line.startswith('VmHWM:')), None)
+        with open('/proc/self/clear_refs', 'w') as ofstream:
+            ofstream.write('5')
+    except OSError:
+        return None
+    return (int(peak) * 1024 if peak is not None else None)
+
+# Profiler of compilation phases and macro expansions.
+# Phases are consecutive: a checkpoint charges the time since the previous checkpoint to the named
+# phase (phases that are interleaved, like expansion and output, get several checkpoints).
+# Macro expansions are timed between entering and leaving call_macro(); self time excludes time
+# spent in nested expansions, cumulative time of recursive macros counts only the outermost
+# expansion. Stacks of expansions are kept as a tree, with self time in every node, for the folded
+# output.
+# Memory is sampled at the first checkpoint of every phase, and then at most once every
+# MEMORY_SAMPLE_INTERVAL seconds (interleaved phases get a checkpoint for every target, and reading
+# the peak is not free).
+class Profiler:
+    MEMORY_SAMPLE_INTERVAL = 0.01
+
+    def __init__(self):
+        self.phases = collections.OrderedDict()
+        self.macros = {}
+        self._last_checkpoint = self._started = time.perf_counter()
+        self._clause_indexes = {}
+        self._active = collections.Counter()
+        self._stacks = [0.0, {}]
+        self._frames = []
+        self._unsampled_phases = set()
+        self._last_sample = self._started
+        peak_memory_use()
+
+    def checkpoint(self, phase):
+        now = time.perf_counter()
+        first = (phase not in self.phases)
+        each = self.phases.setdefault(phase, [0.0, None])
+        each[0] += (now - self._last_checkpoint)
+        self._last_checkpoint = now
+        self._unsampled_phases.add(phase)
+        if first or (now - self._last_sample) >= Profiler.MEMORY_SAMPLE_INTERVAL:
+            self._sample_memory()
+
+    # The peak since the previous sample is charged to every phase checkpointed since then.
+    def _sample_memory(self):
+        peak = peak_memory_use()
+        if peak is not None:
+            for each in self._unsampled_phases:
+                self.phases[each][1] = max((self.phases[each][1] or 0), peak)
+        self._unsampled_phases.clear()
+        self._last_sample = time.perf_counter()
+
+    def _push(self, name):
+        parent = (self._frames[-1][1] if self._frames else self._stacks)
+        node = parent[1].get(name)
+        if node is None:
+            node = parent[1][name] = [0.0, {}]
+        self._frames.append([name, node, time.perf_counter(), 0.0])
+
+    def _pop(self):
+        name, node, started, children = self._frames.pop()
+        elapsed = (time.perf_counter() - started)
+        node[0] += (elapsed - children)
+        if self._frames:
+            self._frames[-1][3] += elapsed
+        return elapsed, (elapsed - children)
+
+    def begin_target(self, name):
+        self._push(name.replace(';', ':'))
+
+    def end_target(self):
+        self._pop()
+
+    def enter(self, macro_name):
+        self._active[macro_name] += 1
+        self._push(macro_name)
+
+    # The clause is None when the expansion was taken from the expansion cache.
+    def leave(self, macro_name, clause, macros):
+        elapsed, self_time = self._pop()
+
+        statistics = self.macros.get(macro_name)
+        if statistics is None:
+            statistics = self.macros[macro_name] = {
+                'expansions': 0,
+                'cache_hits': 0,
+                'clauses': collections.Counter(),
+                'cumulative': 0.0,
+                'self': 0.0,
+            }
+        statistics['expansions'] += 1
+        statistics['self'] += self_time
+
+        self._active[macro_name] -= 1
+        if not self._active[macro_name]:
+            statistics['cumulative'] += elapsed
+
+        if clause is None:
+            statistics['cache_hits'] += 1
+        elif type(clause) is dict:
+            index = self._clause_indexes.get(id(clause))
+            if index is None:
+                index = self._clause_indexes[id(clause)] = next(
+                    i for i, each in enumerate(macros[macro_name]['overloads']) if each is clause
+                )
+            statistics['clauses'][index] += 1
+
+    def report(self):
+        if self._unsampled_phases:
+            self._sample_memory()
+        return {
+            'phases': [
+                { 'name': name, 'seconds': seconds, 'peak_memory': peak, }
+                for name, (seconds, peak) in self.phases.items()
+            ],
+            'total_seconds': (self._last_checkpoint - self._started),
+            'macros': [
+                dict(statistics, name = name, clauses = { str(i): n for i, n in sorted(statistics['clauses'].items()) })
+                for name, statistics in sorted(self.macros.items(), key = lambda each: -each[1]['self'])
+            ],
+        }
+
+    def write_table(self, ofstream):
+        report = self.report()
+
+        def megabytes(peak):
+            return ('{:.1f}'.format(peak / (1 << 20)) if peak is not None else '-')
+
+        print('{:<16} {:>10} {:>18}'.format('phase', 'time [s]', 'peak memory [MiB]'), file = ofstream)
+        for each in report['phases']:
+            print('{:<16} {:>10.3f} {:>18}'.format(each['name'], each['seconds'], megabytes(each['peak_memory'])), file = ofstream)
+        print('{:<16} {:>10.3f}'.format('total', report['total_seconds']), file = ofstream)
+
+        if not report['macros']:
+            return
+        print('', file = ofstream)
+        print('{:<32} {:>10} {:>10} {:>14} {:>14}  {}'.format(
+            'macro', 'expansions', 'cache hits', 'cumulative [s]', 'self [s]', 'clauses selected',
+        ), file = ofstream)
+        for each in report['macros']:
+            print('{:<32} {:>10} {:>10} {:>14.3f} {:>14.3f}  {}'.format(
+                each['name'],
+                each['expansions'],
+                each['cache_hits'],
+                each['cumulative'],
+                each['self'],
+                (' '.join('{}:{}'.format(i, n) for i, n in each['clauses'].items()) or '-'),
+            ), file = ofstream)
+
+    def write_json(self, ofstream):
+        json.dump(self.report(), ofstream, indent = 2)
+        print('', file = ofstream)
+
+    def write_folded(self, ofstream):
+        pending = [(name, node,) for name, node in sorted(self._stacks[1].items(), reverse = True)]
+        while pending:
+            stack, node = pending.pop()
+            microseconds = int(node[0] * 1000000)
+            if microseconds:
+                print('{} {}'.format(stack, microseconds), file = ofstream)
+            pending.extend(('{};{}'.format(stack, name), child,) for name, child in sorted(node[1].items(), reverse = True))
+
+def compile(source, global_variables, macros, cache = None, tracker = None, profiler = None):
+    if tracker is not None:
+        if source['target'].kind != TOKEN_STRING:
+            tracker.variable(str(source['target']))
+        if source['macro'] is not None:
+            tracker.macro(source['macro'])
     target = compile_header(source, global_variables)
-    target = compile_body(target, source, global_variables, macros, source.get('variables', {}))
+    scope = Scope(source.get('variables', {}), global_variables, macros, cache, tracker, profiler)
+    if source.get('dependencies_expression') is not None:
+        compile_dependencies(target, source, scope)
+    target = compile_body(target, source, scope)
     return target
 
-if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print(__doc__)
-        exit(1)
+# Text of a compiled target as a Makefile rule (without the final newline).
+def render_rule(target):
+    lines = []
+    line = []
+    target['body'].append('\n')
+    for part in target['body']:
+        line.append(part)
+        if part == '\n':
+            lines.append('\t' + ' '.join(map(str, line)))
+            line = []
+            continue
+    return '{target}: {dependencies}\n{body}'.format(
+        target = target['target'],
+        dependencies = ' '.join(map(str, map(despecialise, target['dependencies']))),
+        body = ''.join(lines),
+    )
 
-    flag_debugging = False
-    if sys.argv[1] == '--debug':
-        flag_debugging = True
+# Writer of compiled rules.
+# Rules are encoded and written through a single buffer as soon as they are compiled, so memory use
+# does not depend on the size of the Makefile.
+# Output to a file goes to a temporary file in the same directory, which replaces the file only
+# when the writer is closed without an error, and only if contents are different; a hash of
+# everything written is kept so the comparison does not need the contents in memory.
+class MakefileWriter:
+    BUFFER_SIZE = (1 << 20)
+
+    def __init__(self, path = None):
+        self._path = path
+        self._temporary_path = None
+        self._hash = hashlib.sha256()
+        self._size = 0
+        if path is None:
+            self._stream = sys.stdout.buffer
+        else:
+            fd, self._temporary_path = tempfile.mkstemp(dir = (os.path.dirname(path) or '.'), prefix = '.ngmake-')
+            self._stream = open(fd, 'wb', buffering = MakefileWriter.BUFFER_SIZE)
 
-    source_file = sys.argv[1 + int(flag_debugging)]
-    selected_target = (sys.argv[2 + int(flag_debugging)] if len(sys.argv) > (2 + int(flag_debugging)) else None)
+    def __enter__(self):
+        return self
 
-    try:
-        source_text = ''
-        with open(source_file) as ifstream:
-            source_text = ifstream.read()
+    def __exit__(self, exception_type, exception, traceback):
+        if exception_type is None:
+            self.commit()
+        else:
+            self.abort()
+        return False
+
+    def write(self, rule):
+        data = (rule + '\n').encode('utf-8')
+        self._hash.update(data)
+        self._size += len(data)
+        self._stream.write(data)
+
+    def _unchanged(self):
+        try:
+            if os.stat(self._path).st_size != self._size:
+                return False
+            existing = hashlib.sha256()
+            with open(self._path, 'rb') as ifstream:
+                for each in iter(lambda: ifstream.read(MakefileWriter.BUFFER_SIZE), b''):
+                    existing.update(each)
+            return existing.digest() == self._hash.digest()
+        except OSError:
+            return False
 
-        raw_tokens = generic_lexer(source_text)
+    def commit(self):
+        if self._temporary_path is None:
+            self._stream.flush()
+            return
+        self._stream.close()
+        if self._unchanged():
+            os.unlink(self._temporary_path)
+            return
+        try:
+            mode = stat.S_IMODE(os.stat(self._path).st_mode)
+        except OSError:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = (0o666 & ~umask)
+        os.chmod(self._temporary_path, mode)
+        os.replace(self._temporary_path, self._path)
+
+    def abort(self):
+        if self._temporary_path is None:
+            self._stream.flush()
+            return
+        self._stream.close()
+        os.unlink(self._temporary_path)
+
+# Ninja backend.
+# A compiled target is rendered into its output, explicit and implicit inputs, and the command
+# building it (None if there are no steps). Explicit inputs are the longest leading run of the
+# dependencies which appears in the recipe; in the command it is replaced by $in, and the target by
+# $out, so commands of targets built the same way are the same and can share a rule.
+# Special targets of Make have no counterpart in Ninja and are rendered as ().
+MAKE_SPECIAL_TARGETS = frozenset((
+    '.PHONY', '.SUFFIXES', '.DEFAULT', '.PRECIOUS', '.INTERMEDIATE', '.SECONDARY',
+    '.SECONDEXPANSION', '.DELETE_ON_ERROR', '.IGNORE', '.LOW_RESOLUTION_TIME', '.SILENT',
+    '.EXPORT_ALL_VARIABLES', '.NOTPARALLEL', '.ONESHELL', '.POSIX',
+))
+
+def escape_ninja_path(path):
+    return path.replace('$', '$$').replace(' ', '$ ').replace(':', '$:')
+
+def contains_run(line, run):
+    return any((line[i:i+len(run)] == run) for i in range(len(line) - len(run) + 1))
+
+def render_ninja_build(target):
+    output = str(target['target'])
+    if output in MAKE_SPECIAL_TARGETS:
+        return ()
+    inputs = [str(each) for each in map(despecialise, target['dependencies'])]
+
+    lines = [[]]
+    for part in target['body']:
+        if part == '\n':
+            lines.append([])
+        else:
+            lines[-1].append(str(part))
+    lines = [each for each in lines if each]
+
+    # Make's recipe prefixes: '@' (do not echo) and '+' mean nothing to Ninja, and a failure of a
+    # step prefixed with '-' is ignored
+    prefixes = []
+    for i, line in enumerate(lines):
+        command = line[0].lstrip('@-+ \t')
+        prefixes.append(line[0][:len(line[0]) - len(command)])
+        lines[i] = ([command] if command else []) + line[1:]
+
+    explicit = len(inputs)
+    while explicit and not any(contains_run(each, inputs[:explicit]) for each in lines):
+        explicit -= 1
+    run = inputs[:explicit]
+
+    steps = []
+    for prefix, line in zip(prefixes, lines):
+        if not line:
+            continue
+        shaped = []
+        i = 0
+        while i < len(line):
+            if run and line[i:i+len(run)] == run:
+                shaped.append('$in')
+                i += len(run)
+                continue
+            shaped.append('$out' if line[i] == output else line[i].replace('$', '$$'))
+            i += 1
+        step = ' '.join(shaped)
+        steps.append(('({} || true)'.format(step) if '-' in prefix else step))
+
+    return output, run, inputs[explicit:], (' && '.join(steps) or None)
+
+# Writer of a Ninja build file; writes through a MakefileWriter.
+# Make merges rules of targets with the same name (dependencies are joined, the last recipe wins),
+# and Ninja allows only one build statement per output, so build statements are collected and
+# written when the writer is closed. Explicit inputs are those of the winning recipe (which its
+# $in refers to), all other dependencies become implicit. Rules are named in the order of their
+# first use.
+class NinjaWriter:
+    def __init__(self, writer):
+        self._writer = writer
+        self._builds = collections.OrderedDict()
+
+    def write(self, build):
+        if not build:
+            return
+        output, explicit, implicit, command = build
+        if output not in self._builds:
+            self._builds[output] = (explicit, implicit, command,)
+            return
+        merged_explicit, merged_implicit, merged_command = self._builds[output]
+        if command is None:
+            explicit, command = merged_explicit, merged_command
+        dependencies = merged_explicit + merged_implicit + explicit + implicit
+        implicit = []
+        for each in dependencies:
+            if each not in explicit and each not in implicit:
+                implicit.append(each)
+        self._builds[output] = (explicit, implicit, command,)
+
+    def close(self):
+        rules = {}
+        self._writer.write('# generated by ngmake\nninja_required_version = 1.3\n')
+        for output, (explicit, implicit, command) in self._builds.items():
+            rule = 'phony'
+            if command is not None:
+                rule = rules.get(command)
+                if rule is None:
+                    rule = rules[command] = 'rule_{}'.format(len(rules))
+                    self._writer.write('rule {}\n  command = {}\n'.format(rule, command))
+            self._writer.write('build {}: {}{}{}\n'.format(
+                escape_ninja_path(output),
+                rule,
+                ''.join((' ' + escape_ninja_path(each)) for each in explicit),
+                ((' |' + ''.join((' ' + escape_ninja_path(each)) for each in implicit)) if implicit else ''),
+            ))
+        if self._builds:
+            self._writer.write('default {}'.format(escape_ninja_path(next(iter(self._builds)))))
+
+# Builds for --run.
+# A compiled target is rendered into its name, dependencies, and the lines of its recipe.
+def render_build_node(target):
+    lines = [[]]
+    for part in target['body']:
+        if part == '\n':
+            lines.append([])
+        else:
+            lines[-1].append(str(part))
+    return (
+        str(target['target']),
+        [str(each) for each in map(despecialise, target['dependencies'])],
+        [' '.join(each) for each in lines if each],
+    )
 
-        tokens = reduce_arrow_operator(raw_tokens)
-        tokens = reduce_spread_operator(tokens)
+def modification_time(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def run_recipe(name, lines):
+    for line in lines:
+        command = line.lstrip('@-+ \t')
+        prefix = line[:len(line) - len(command)]
+        if '@' not in prefix:
+            print(command, flush = True)
+        status = subprocess.call(command, shell = True)
+        if status != 0 and '-' not in prefix:
+            return status
+    return 0
+
+# Graph of targets built by --run.
+# Nodes are collected like Make collects rules (dependencies of targets with the same name are
+# joined, the last recipe wins). When run, nodes needed by the goals are ordered topologically:
+# every node counts its dependencies which are not yet built, and is put on the worklist of ready
+# nodes when the count drops to zero. Ready nodes which are up to date are finished immediately,
+# the others are started in a pool of threads (recipes themselves run in child processes).
+class BuildGraph:
+    def __init__(self):
+        self._nodes = collections.OrderedDict()
+
+    def write(self, node):
+        name, dependencies, lines = node
+        if name not in self._nodes:
+            self._nodes[name] = (list(dependencies), lines,)
+            return
+        merged_dependencies, merged_lines = self._nodes[name]
+        merged_dependencies.extend(each for each in dependencies if each not in merged_dependencies)
+        self._nodes[name] = (merged_dependencies, (lines or merged_lines),)
+
+    def goals(self, patterns):
+        names = [each for each in self._nodes if each not in MAKE_SPECIAL_TARGETS]
+        if not patterns:
+            return names[:1]
+        goals = []
+        for pattern in patterns:
+            matching = fnmatch.filter(names, pattern)
+            if not matching:
+                matching = [pattern]
+            goals.extend(each for each in matching if each not in goals)
+        return goals
+
+    # Names of nodes needed by the goals, dependencies before their dependents.
+    def _needed(self, goals):
+        order = []
+        state = {}
+        for goal in goals:
+            if goal not in self._nodes or goal in state:
+                continue
+            state[goal] = 'visiting'
+            stack = [(goal, iter(self._nodes[goal][0]),)]
+            while stack:
+                name, dependencies = stack[-1]
+                for each in dependencies:
+                    if each not in self._nodes:
+                        continue
+                    if state.get(each) == 'visiting':
+                        raise Exception('circular dependency', each, name)
+                    if each not in state:
+                        state[each] = 'visiting'
+                        stack.append((each, iter(self._nodes[each][0]),))
+                        break
+                else:
+                    stack.pop()
+                    state[name] = 'done'
+                    order.append(name)
+        return order
+
+    def run(self, goals, jobs = 1, keep_going = False):
+        phony = set(self._nodes['.PHONY'][0] if '.PHONY' in self._nodes else ())
+
+        order = self._needed(goals)
+        pending = {}
+        dependents = collections.defaultdict(list)
+        for name in order:
+            dependencies = set(each for each in self._nodes[name][0] if each in self._nodes)
+            pending[name] = len(dependencies)
+            for each in dependencies:
+                dependents[each].append(name)
+        worklist = collections.deque(name for name in order if pending[name] == 0)
+
+        # for finished nodes: whether it was rebuilt, and the longest chain of recipes ending
+        # with it (duration, names)
+        rebuilt = {}
+        chains = {}
+        failed = set()
+        errors = []
+        running = {}
+        begin = time.perf_counter()
+
+        def finish(name, was_rebuilt, duration):
+            rebuilt[name] = was_rebuilt
+            longest = max((chains[each] for each in self._nodes[name][0] if each in chains), default = (0.0, (),))
+            chains[name] = ((longest[0] + duration, longest[1] + (name,),) if was_rebuilt else longest)
+            for each in dependents[name]:
+                pending[each] -= 1
+                if pending[each] == 0:
+                    worklist.append(each)
+
+        def fail(name, message):
+            failed.add(name)
+            errors.append(message)
+            for each in dependents[name]:
+                pending[each] -= 1
+                if pending[each] == 0:
+                    worklist.append(each)
+
+        def outdated(name):
+            if name in phony:
+                return True
+            mtime = modification_time(name)
+            if mtime is None:
+                return True
+            for each in self._nodes[name][0]:
+                if rebuilt.get(each) and (each in phony or modification_time(each) is None):
+                    return True
+                dependency_mtime = modification_time(each)
+                if dependency_mtime is not None and dependency_mtime > mtime:
+                    return True
+            return False
 
-        raw_targets = match_targets(tokens)
-        raw_variables = match_variables(tokens)
-        raw_macros = match_macros(tokens)
-        raw_imports = match_imports(tokens)
+        with concurrent.futures.ThreadPoolExecutor(max(jobs, 1)) as pool:
+            while worklist or running:
+                while worklist and (len(running) < max(jobs, 1)) and (keep_going or not errors):
+                    name = worklist.popleft()
+                    dependencies, lines = self._nodes[name]
+                    if any((each in failed) for each in dependencies):
+                        fail(name, 'target {} not remade because of errors'.format(repr(name)))
+                        continue
+                    missing = [each for each in dependencies if each not in self._nodes and modification_time(each) is None]
+                    if missing:
+                        fail(name, 'no rule to make target {}, needed by {}'.format(repr(missing[0]), repr(name)))
+                        continue
+                    if not outdated(name):
+                        finish(name, False, 0.0)
+                        continue
+                    if not lines:
+                        finish(name, True, 0.0)
+                        continue
+                    running[pool.submit(run_recipe, name, lines)] = (name, time.perf_counter(),)
+                if not running:
+                    break
+                done, _ = concurrent.futures.wait(running, return_when = concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name, started = running.pop(future)
+                    status = future.result()
+                    if status == 0:
+                        finish(name, True, time.perf_counter() - started)
+                    else:
+                        fail(name, 'recipe for target {} failed with exit status {}'.format(repr(name), status))
+
+        for goal in goals:
+            if goal not in self._nodes and modification_time(goal) is None:
+                errors.append('no rule to make target {}'.format(repr(goal)))
+
+        for message in errors:
+            print('error: {}'.format(message), file = sys.stderr)
+        duration, path = max(chains.values(), default = (0.0, (),))
+        print('build {} in {:.3f}s ({} rebuilt, {} up to date); critical path {:.3f}s{}'.format(
+            ('failed' if errors else 'finished'),
+            time.perf_counter() - begin,
+            sum(1 for each in rebuilt.values() if each),
+            sum(1 for each in rebuilt.values() if not each),
+            duration,
+            (': ' + ' -> '.join(path) if path else ''),
+        ), file = sys.stderr)
+        return (1 if errors else 0)
+
+# Content-hash stamps.
+# Stamp files live in a directory which also holds the list of inputs (written when the targets
+# are compiled) and the stamp database: modification time, size, and hash of contents of every
+# input. An input is hashed again only if its modification time or size is different from the one
+# recorded in the database, and its stamp file is written only if the hash is different (or the
+# stamp file is missing), so the stamp's modification time changes only with contents of the input.
+STAMPS_VERSION = 1
+STAMP_MMAP_THRESHOLD = (1 << 20)
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as ifstream:
+        if os.fstat(ifstream.fileno()).st_size < STAMP_MMAP_THRESHOLD:
+            digest.update(ifstream.read())
+        else:
+            with mmap.mmap(ifstream.fileno(), 0, access = mmap.ACCESS_READ) as contents:
+                digest.update(contents)
+    return digest.hexdigest()
+
+def stamp_path(directory, path):
+    return os.path.join(directory, 'files', hashlib.sha256(path.encode('utf-8')).hexdigest()[:32])
+
+def update_stamps(directory, inputs, jobs = None):
+    database_path = os.path.join(directory, 'database')
+    database = load_pickle(database_path)
+    if type(database) is not dict or database.get('version') != STAMPS_VERSION:
+        database = {'files': {}}
+    known = database['files']
+
+    os.makedirs(os.path.join(directory, 'files'), exist_ok = True)
+    files = {}
+    changed = []
+    for path in inputs:
+        try:
+            status = os.stat(path)
+        except OSError:
+            status = None
+        if status is None or not stat.S_ISREG(status.st_mode):
+            try:
+                os.unlink(stamp_path(directory, path))
+            except OSError:
+                pass
+            continue
+        record = known.get(path)
+        if record is not None and record[:2] == (status.st_mtime_ns, status.st_size,):
+            files[path] = record
+        else:
+            changed.append((path, status,))
 
-        macros, _ = run_imports(map(lambda s: str(s[1])[1:-1], raw_imports), {}, ())
+    # hashlib releases the GIL while hashing so threads are enough
+    with concurrent.futures.ThreadPoolExecutor(jobs or os.cpu_count() or 1) as pool:
+        for (path, status), digest in zip(changed, pool.map(hash_file, [each[0] for each in changed])):
+            files[path] = (status.st_mtime_ns, status.st_size, digest,)
 
-        macros.update(dict({ each['name']: each['overloads'] for each in map(prepare_macro, raw_macros) }))
+    for path, (_, _, digest) in files.items():
+        stamp = stamp_path(directory, path)
+        record = known.get(path)
+        if record is not None and record[2] == digest and os.path.exists(stamp):
+            continue
+        with open(stamp, 'w') as ofstream:
+            ofstream.write(digest + '\n')
+
+    store_pickle(database_path, {'version': STAMPS_VERSION, 'files': files})
+
+def stamped_inputs(directory):
+    return (load_pickle(os.path.join(directory, 'inputs')) or [])
+
+# Dependencies of compiled targets (rendered by render_build_node) that are not targets themselves
+# are replaced by their stamp files; the replaced inputs are collected, in the order of their
+# first appearance.
+# Only regular files are stamped. Other dependencies (directories, and files which do not exist
+# when the targets are compiled) are left as they are, so Make treats them as it would without
+# stamps, e.g. stops with "No rule to make target" for a missing one.
+class Stamps:
+    def __init__(self, directory, targets):
+        self.directory = directory
+        self._targets = targets
+        self._inputs = collections.OrderedDict()
+        self._regular = {}
+
+    def _stamped(self, path):
+        regular = self._regular.get(path)
+        if regular is None:
+            try:
+                regular = stat.S_ISREG(os.stat(path).st_mode)
+            except OSError:
+                regular = False
+            self._regular[path] = regular
+        return regular
+
+    def rewrite(self, node):
+        name, dependencies, lines = node
+        if name in MAKE_SPECIAL_TARGETS:
+            return node
+        stamped = []
+        for each in dependencies:
+            if each in self._targets or not self._stamped(each):
+                stamped.append(each)
+                continue
+            self._inputs[each] = None
+            stamped.append(stamp_path(self.directory, each))
+        return name, stamped, lines
+
+    def inputs(self):
+        return list(self._inputs)
+
+    def save_inputs(self):
+        os.makedirs(self.directory, exist_ok = True)
+        path = os.path.join(self.directory, 'inputs')
+        if load_pickle(path) != self.inputs():
+            store_pickle(path, self.inputs())
+
+    def update(self):
+        self.save_inputs()
+        update_stamps(self.directory, self.inputs())
+
+# Writer of a Makefile with stamped dependencies; writes through a MakefileWriter.
+# Every stamp file depends on a phony target updating all stamps, and has an empty recipe so Make
+# checks its modification time again after the update; targets depending on a stamp file are
+# rebuilt only if the update rewrote it. Rules of stamp files are written when the writer is
+# closed (after all other rules, so they do not become the default goal).
+class StampWriter:
+    UPDATE_TARGET = '.ngmake-update-stamps'
+
+    def __init__(self, writer, stamps):
+        self._writer = writer
+        self._stamps = stamps
+
+    def write(self, node):
+        name, dependencies, lines = self._stamps.rewrite(node)
+        self._writer.write('{}: {}\n{}'.format(
+            name,
+            ' '.join(dependencies),
+            (''.join('\t{} \n'.format(each) for each in lines) or '\t\n'),
+        ))
+
+    def close(self):
+        self._stamps.save_inputs()
+        for each in self._stamps.inputs():
+            self._writer.write('{}: {} ;'.format(stamp_path(self._stamps.directory, each), StampWriter.UPDATE_TARGET))
+        self._writer.write('.PHONY: {}\n{}:\n\t@{}'.format(
+            StampWriter.UPDATE_TARGET,
+            StampWriter.UPDATE_TARGET,
+            ' '.join(map(shlex.quote, (sys.executable, os.path.abspath(__file__), '--update-stamps', self._stamps.directory,))),
+        ))
+
+# Backends: rendering of a compiled target, and the writer of rendered targets (None if rendered
+# targets are written as they are).
+BACKENDS = {
+    'make': (render_rule, None,),
+    'ninja': (render_ninja_build, NinjaWriter,),
+}
+
+# Compile a target and render it using the backend, and names its expansion depended on if tracking.
+def compile_rule(source, global_variables, macros, cache = None, tracking = False, profiler = None, render = render_rule):
+    tracker = (DependencyTracker() if tracking else None)
+    if profiler is not None:
+        profiler.begin_target(str(resolve(source['target'], global_variables, {})))
+    rule = render(compile(source, global_variables, macros, cache, tracker, profiler))
+    if profiler is not None:
+        profiler.end_target()
+    return rule, (tracker.dependencies() if tracking else None)
+
+# Parallel compilation.
+# Targets, macros, and variables are sent to every worker once, when the pool is started; tasks
+# are just ranges of indexes of targets. Every task also reports statistics of the worker's
+# expansion cache, and directories it listed for glob() and #include directives it read for
+# includes() (so the main process can save them).
+worker_context = None
+
+def initialize_worker(sources, global_variables, macros, cache_size, tracking, render):
+    global worker_context
+    worker_context = {
+        'sources': sources,
+        'global_variables': global_variables,
+        'macros': macros,
+        'cache': (ExpansionCache(cache_size) if cache_size > 0 else None),
+        'tracking': tracking,
+        'render': render,
+    }
 
-        def std_match_regex(s, pat):
-            result = [('true' if re.compile(str(pat)).match(str(s)) else 'false')]
-            return result
-        macros['match'] = std_match_regex
+def compile_chunk(indexes):
+    context = worker_context
+    cache = context['cache']
+    rules = [
+        compile_rule(context['sources'][i], context['global_variables'], context['macros'], cache, context['tracking'], render = context['render'])
+        for i in indexes
+    ]
+    statistics = ((cache.hits, cache.misses, len(cache),) if cache is not None else None)
+    return os.getpid(), statistics, (directory_index.take_listed(), include_scanner.take_scanned(),), rules
+
+# Yields results of compile_rule() for all sources, in order.
+# Latest statistics of expansion caches of the workers are put in worker_statistics (by pid).
+def compile_in_parallel(sources, global_variables, macros, jobs, cache_size, tracking, render, worker_statistics):
+    chunk_size = max(1, min(64, len(sources) // (jobs * 8)))
+    chunks = [range(i, min(i + chunk_size, len(sources))) for i in range(0, len(sources), chunk_size)]
+    with multiprocessing.Pool(jobs, initialize_worker, (sources, global_variables, macros, cache_size, tracking, render,)) as pool:
+        for pid, statistics, (listed, scanned), rules in pool.imap(compile_chunk, chunks):
+            if statistics is not None:
+                worker_statistics[pid] = statistics
+            directory_index.merge(listed)
+            include_scanner.merge(scanned)
+            yield from rules
 
-        targets = list(map(prepare_target, raw_targets))
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        exit(1)
 
-        variables = dict({ each['name'] : each['value'] for each in map(prepare_variable, raw_variables) })
+    argument_parser = argparse.ArgumentParser(prog = 'ngmake', add_help = False)
+    argument_parser.add_argument('--debug', action = 'store_true')
+    argument_parser.add_argument('--expansion-cache-size', type = int, default = 4096)
+    argument_parser.add_argument('--no-module-cache', action = 'store_true')
+    argument_parser.add_argument('--verify-module-cache', action = 'store_true')
+    argument_parser.add_argument('--incremental', metavar = 'STATE_FILE')
+    argument_parser.add_argument('-j', '--jobs', type = int, default = 1)
+    argument_parser.add_argument('-o', '--output')
+    argument_parser.add_argument('--run', action = 'store_true')
+    argument_parser.add_argument('-k', '--keep-going', action = 'store_true')
+    argument_parser.add_argument('--stamps', metavar = 'DIRECTORY')
+    argument_parser.add_argument('--update-stamps', metavar = 'DIRECTORY')
+    argument_parser.add_argument('--glob-index', metavar = 'FILE')
+    argument_parser.add_argument('--include-cache', metavar = 'FILE')
+    argument_parser.add_argument('--backend', choices = tuple(BACKENDS), default = 'make')
+    argument_parser.add_argument('--profile', action = 'store_true')
+    argument_parser.add_argument('--profile-format', choices = ('table', 'json',))
+    argument_parser.add_argument('--profile-folded', metavar = 'FILE')
+    argument_parser.add_argument('source_file', nargs = '?')
+    argument_parser.add_argument('selected_targets', nargs = '*')
+    args = argument_parser.parse_args()
+
+    if args.update_stamps:
+        update_stamps(args.update_stamps, stamped_inputs(args.update_stamps))
+        exit(0)
+    if args.source_file is None:
+        print(__doc__)
+        exit(1)
+    if args.stamps and args.backend == 'ninja':
+        argument_parser.error('--stamps is not available with --backend ninja')
+
+    flag_debugging = args.debug
+    source_file = args.source_file
+    selected_targets = args.selected_targets
+    expansion_cache = (ExpansionCache(args.expansion_cache_size) if args.expansion_cache_size > 0 else None)
+    module_cache = (None if args.no_module_cache else ModuleCache(verify = args.verify_module_cache))
+
+    profiler = None
+    checkpoint = (lambda phase: None)
+    if args.profile or args.profile_format or args.profile_folded:
+        profiler = Profiler()
+        checkpoint = profiler.checkpoint
+
+    if args.glob_index:
+        directory_index.load(args.glob_index)
+    if args.include_cache:
+        include_scanner.load(args.include_cache)
 
-        compiled_targets = []
-        if selected_target is None:
-            compiled_targets = map(lambda each: compile(source = each, global_variables = variables, macros = macros), targets)
+    try:
+        source_text = ''
+        with open(source_file) as ifstream:
+            source_text = ifstream.read()
+        checkpoint('read')
+
+        registry = ModuleRegistry(module_cache)
+
+        # with selected targets only statements they need are lexed and prepared; targets are
+        # (tokens, start, limit) of their statements
+        # dependencies of a target are known only after it is compiled, so --run compiles all
+        # targets and selects from the compiled ones
+        if selected_targets and not args.run:
+            source_statements = SourceStatements(source_text)
+            checkpoint('statements')
+            macros = registry.namespace(source_statements.import_names(), {})
+            macros.maps.append(builtin_macros())
+            checkpoint('imports')
+
+            selected = select_targets(source_statements, selected_targets)
+            own_macros, variables = prepare_reachable(source_statements, selected, macros)
+            macros.maps[0].update(own_macros)
+            target_statements = list(map(source_statements.statement, selected))
+        else:
+            tokens = generic_lexer(source_text)
+            checkpoint('lex')
+            statements = split_statements(tokens)
+            checkpoint('statements')
+
+            own_macros = dict({ each['name']: each for each in map(lambda each: prepare_macro(tokens, *each), statements[TOKEN_MACRO]) })
+            checkpoint('prepare')
+            macros = registry.namespace(list(import_names(tokens, statements[TOKEN_IMPORT])), own_macros)
+            macros.maps.append(builtin_macros())
+            checkpoint('imports')
+            variables = dict({ each['name'] : each['value'] for each in map(lambda each: prepare_variable(tokens, *each), statements[TOKEN_LET]) })
+            target_statements = [(tokens, start, limit,) for start, limit in statements[TOKEN_DO]]
+
+        # the namespace is looked up for every name and call during expansion so flatten it
+        # once into a single table
+        macros = dict(macros)
+
+        incremental_state = None
+        if args.incremental:
+            incremental_state = IncrementalState(args.incremental, Fingerprints(macros, variables), ('run' if args.run else 'stamps' if args.stamps else args.backend))
+
+        # every target is (name, key in the incremental state, prepared source, reused rule)
+        targets = []
+        for tokens, start, end in target_statements:
+            if incremental_state is not None:
+                key = fingerprint_tokens(tokens, start, end)
+                record = incremental_state.reuse(key)
+                if record is not None:
+                    targets.append((record['name'], key, None, record['rule'],))
+                    continue
+            else:
+                key = None
+            source = prepare_target(tokens, start, end, macros)
+            # the name of the target as it is written to the output (it may be given by a variable)
+            name = str(resolve(source['target'], variables, {}))
+            targets.append((name, key, source, None,))
+        checkpoint('prepare')
+
+        tracking = (incremental_state is not None)
+        stamps = (Stamps(args.stamps, set(each[0] for each in targets)) if args.stamps else None)
+        if args.run:
+            render, backend_writer = render_build_node, None
+        elif stamps is not None:
+            render, backend_writer = render_build_node, (lambda writer: StampWriter(writer, stamps))
         else:
-            targets = filter(lambda each: str(each['target'])[1:-1] == selected_target, targets)
-            compiled_targets = map(lambda each: compile(source = each, global_variables = variables, macros = macros), targets)
+            render, backend_writer = BACKENDS[args.backend]
+        worker_statistics = {}
+
+        def compiled_rules():
+            sources = [each[2] for each in targets if each[3] is None]
+            if args.jobs > 1 and len(sources) > 1 and profiler is None:
+                results = compile_in_parallel(sources, variables, macros, args.jobs, args.expansion_cache_size, tracking, render, worker_statistics)
+            else:
+                results = (compile_rule(each, variables, macros, expansion_cache, tracking, profiler, render) for each in sources)
+
+            for name, key, source, rule in targets:
+                if rule is None:
+                    rule, dependencies = next(results)
+                    if incremental_state is not None:
+                        incremental_state.record(key, name, dependencies, rule)
+                yield rule
+
+        build_status = 0
         if flag_debugging:
-            list(compiled_targets)
+            list(compiled_rules())
+            checkpoint('expansion')
+            if expansion_cache is not None:
+                statistics = [(expansion_cache.hits, expansion_cache.misses, len(expansion_cache),)]
+                statistics.extend(worker_statistics.values())
+                print('expansion cache: {} hits, {} misses, {} entries'.format(
+                    *map(sum, zip(*statistics))
+                ), file = sys.stderr)
+            if module_cache is not None:
+                print('module cache: {} hits, {} misses'.format(
+                    module_cache.hits,
+                    module_cache.misses,
+                ), file = sys.stderr)
+            if incremental_state is not None:
+                print('incremental: {} rules reused, {} expanded'.format(
+                    incremental_state.reused,
+                    incremental_state.expanded,
+                ), file = sys.stderr)
+        elif args.run:
+            graph = BuildGraph()
+            for node in compiled_rules():
+                graph.write(node if stamps is None else stamps.rewrite(node))
+            checkpoint('expansion')
+            if incremental_state is not None:
+                incremental_state.save()
+            if stamps is not None:
+                stamps.update()
+                checkpoint('stamps')
+            build_status = graph.run(graph.goals(selected_targets), args.jobs, args.keep_going)
+            checkpoint('build')
         else:
-            for i, each in enumerate(compiled_targets):
-                lines = []
-                line = []
-                each['body'].append('\n')
-                for part in each['body']:
-                    line.append(part)
-                    if part == '\n':
-                        lines.append('\t' + ' '.join(map(str, line)))
-                        line = []
-                        continue
-                print('{target}: {dependencies}\n{body}'.format(
-                    target = each['target'],
-                    dependencies = ' '.join(map(str, map(despecialise, each['dependencies']))),
-                    body = ''.join(lines),
-                ))
+            with MakefileWriter(args.output) as writer:
+                output = (backend_writer(writer) if backend_writer is not None else writer)
+                for rule in compiled_rules():
+                    checkpoint('expansion')
+                    output.write(rule)
+                    checkpoint('output')
+                if backend_writer is not None:
+                    output.close()
+            checkpoint('output')
+
+        if incremental_state is not None and not args.run:
+            incremental_state.save(keep_previous = bool(selected_targets))
+            checkpoint('state')
+        if args.glob_index:
+            directory_index.save(args.glob_index)
+        if args.include_cache:
+            include_scanner.save(args.include_cache)
+
+        if profiler is not None:
+            if args.profile_format == 'json':
+                profiler.write_json(sys.stderr)
+            else:
+                profiler.write_table(sys.stderr)
+            if args.profile_folded:
+                with open(args.profile_folded, 'w') as ofstream:
+                    profiler.write_folded(ofstream)
+
+        if build_status != 0:
+            exit(build_status)
     except InvalidSyntax as e:
         token, message = e.args
         line, character = token.position()